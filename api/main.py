@@ -1,6 +1,10 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 from api.routes import router
+from core.db_async import open_pool, close_pool
+from services.redis_client import close_async_redis
+from core.metrics import registry
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 # FastAPI app metadata
 app = FastAPI(
@@ -21,6 +25,21 @@ app.add_middleware(
 # Register routes
 app.include_router(router)
 
+# Prometheus scrape endpoint (stage timings, queue waits, tile times)
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return Response(generate_latest(registry()), media_type=CONTENT_TYPE_LATEST)
+
+# Database pool and the async Redis client live for the lifetime of the app
+@app.on_event("startup")
+async def startup():
+    await open_pool()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await close_pool()
+    await close_async_redis()
+
 # User (Telegram) ──▶ Bot (bot.py) ──▶ POST /upscale ──▶ FastAPI (main.py) ──▶ upscale.py ──▶ Result image
 #                                                                                     ▲
 #                                                                                     └── RealESRGAN Model
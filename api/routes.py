@@ -1,19 +1,46 @@
+import json
 import os
+import re
 import uuid
+from contextlib import aclosing
+from typing import List, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from core.db import get_user_generations
-from services.tasks import upscale_image_task
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from core.db_async import get_user_generations
+from core import ingest
+from core.storage import get_blob_store
+from core.metrics import job_context, span
+from core.models import resolve_tier
+from services.pipeline import new_job, new_album_job, submit_job
+from services.tasks import deliver_to_waiters
+from services import admission, job_events, scheduler
 from services.celery_app import celery
+from services import result_cache
 
 router = APIRouter()
 
-TEMP_DIR = os.path.abspath("temp")
-os.makedirs(TEMP_DIR, exist_ok=True)
+store = get_blob_store()
+
+# Route jobs through the fair scheduler (services/scheduler.py) instead of straight to Celery.
+# Only turn this on together with a running dispatcher (python -m services.scheduler);
+# without one, scheduled jobs wait in Redis forever.
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "0") == "1"
+
+# A caller's job id only labels spans and logs; task ids and blob keys are always generated
+# here, so a repeated or guessed id can't make two jobs share keys. Only simple tokens are kept.
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+# Push-based result delivery (services/job_events.py)
+LONG_POLL_MAX = int(os.getenv("LONG_POLL_MAX", "60"))  # Longest a GET /result/{id}/wait may hold the connection
+SSE_TIMEOUT = int(os.getenv("SSE_TIMEOUT", "900"))  # Seconds before an event stream gives up on a job
+SSE_HEARTBEAT = 15  # Keep-alive comment interval, so proxies don't drop idle streams
+
+ALBUM_MAX_IMAGES = 10  # Telegram's media group limit
 
 @router.get("/", summary="Home", tags=["Utility"])
 async def read_root():
@@ -21,7 +48,10 @@ async def read_root():
         "message": "👋 Welcome to the Image Upscaler API!",
         "endpoints": {
             "POST /upscale": "Upload an image to upscale",
+            "POST /upscale/album": "Upload 2-10 images to upscale as one job",
             "GET /result/{task_id}": "Get the upscaled result using task ID",
+            "GET /result/{task_id}/wait": "Long-poll: wait for the result and download it",
+            "GET /result/{task_id}/events": "Server-Sent Events with the task's progress",
             "GET /health": "Check server health",
             "GET /docs": "Swagger UI",
             "GET /redoc": "ReDoc documentation"
@@ -39,40 +69,199 @@ async def health_check():
     response_description="Returns a task ID to check result later",
     responses={
         200: {"description": "Task queued successfully"},
-        400: {"description": "Invalid file type"},
+        400: {"description": "Not a JPEG/PNG image, or invalid model tier"},
+        413: {"description": "Image file or dimensions too large"},
+        429: {"description": "Too many images from this user waiting"},
+        503: {"description": "Free queue is full; retry after the Retry-After header"},
         500: {"description": "Internal server error"},
     }
 )
 async def upscale_endpoint(
     file: UploadFile = File(..., description="The image file to upscale (JPEG or PNG)"),
-    chat_id: str = Form(..., description="Telegram chat ID to send result back to")
+    chat_id: str = Form(..., description="Telegram chat ID to send result back to"),
+    job_id: Optional[str] = Form(None, description="Trace id assigned by the caller; tags the job's logs and spans"),
+    tier: Optional[str] = Form(None, description="Model tier (full, light, x2); chosen from the user type if omitted")
 ):
-    if file.content_type not in ["image/jpeg", "image/png"]:
-        raise HTTPException(status_code=400, detail="Only JPEG and PNG images are supported.")
+    task_id = uuid.uuid4().hex
+    trace_id = _trace_id(job_id, task_id)
+    with job_context(trace_id):
+        return await _queue_upscale(file, chat_id, task_id, trace_id, tier)
 
-    uid = uuid.uuid4().hex
-    input_path = os.path.join(TEMP_DIR, f"input_{uid}.jpg")
-    output_path = os.path.join(TEMP_DIR, f"output_{uid}.jpg")
+def _trace_id(job_id, task_id):
+    return job_id if job_id and JOB_ID_PATTERN.match(job_id) else task_id
+
+async def _probe(file):
+    # Check format and dimensions from the header (the client's content_type isn't trusted)
+    # and hash the spooled upload in chunks, off the event loop
+    try:
+        with span("probe"):
+            return await run_in_threadpool(ingest.probe, file.file)
+    except ingest.ImageRejected as e:
+        raise HTTPException(status_code=e.status, detail=str(e))
+
+async def _admit(queue_name, tier, tiles):
+    # Reads queue depths and timing samples from Redis, so keep it off the event loop
+    try:
+        return await run_in_threadpool(admission.admit, queue_name, tier, tiles)
+    except admission.Shed as e:
+        raise HTTPException(
+            status_code=503,
+            detail="The free queue is full right now. Please try again later.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
 
-    with open(input_path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+async def _queue_upscale(file, chat_id, task_id, trace_id, requested_tier):
+    info = await _probe(file)
 
     # Check if user has vip generations
-    user_data = get_user_generations(int(chat_id))  # chat_id = telegram_id
+    with span("db"):
+        user_data = await get_user_generations(int(chat_id))  # chat_id = telegram_id
     user_is_vip = user_data and user_data["vip_tokens"] > 0
 
     # Choose queue based on generation type
     queue_name = "vip" if user_is_vip else "free"
 
-    task = upscale_image_task.apply_async(args=[input_path, output_path, chat_id], queue=queue_name)
+    # Choose the model: VIP users get the full one, free users and small images a cheaper one
+    try:
+        tier = resolve_tier(requested_tier, user_is_vip, (info["width"], info["height"]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Keyed by the hash of the bytes actually uploaded; a client-sent id must never pick the result.
+    # Results differ per model tier, so the tier is part of the cache key.
+    digest = result_cache.tier_key(info["sha256"], tier)
+
+    # Same image already upscaled: resend Telegram's copy without touching the model
+    cached_file_id = await run_in_threadpool(result_cache.lookup, digest)
+    if cached_file_id:
+        job = new_job(task_id, chat_id, content_hash=digest, cached_file_id=cached_file_id, tier=tier,
+                      trace_id=trace_id)
+        task = await run_in_threadpool(submit_job, job, queue_name)
+        return {
+            "status": "cached",
+            "task_id": task.id,
+            "message": "Image was already upscaled, resending the result"
+        }
+
+    # Estimate the wait, and shed free jobs once the free queue is past its limits. Riding along
+    # with a job already computing this image costs nothing, so that case is never shed; the
+    # check runs before join_inflight, so a shed request never becomes a leader others wait on.
+    tiles = admission.estimate_tiles(info["width"], info["height"], tier)
+    eta = None
+    if not await run_in_threadpool(result_cache.inflight_leader, digest):
+        eta = await _admit(queue_name, tier, tiles)
+
+    # Same image currently being upscaled: ride along with that job
+    leader_task_id = await run_in_threadpool(result_cache.join_inflight, digest, task_id, chat_id)
+    if leader_task_id:
+        print(f"[🔗 COALESCED] job={task_id} joined job={leader_task_id}")
+        return {
+            "status": "coalesced",
+            "task_id": leader_task_id,
+            "message": "Identical image is already being upscaled"
+        }
+    if eta is None:
+        # The job seen above finished before we joined, so this request leads after all
+        eta = await run_in_threadpool(admission.estimate, queue_name, tier, tiles)
+
+    input_key = f"input_{task_id}.jpg"
+
+    try:
+        # Chunked copy to the blob store (shrunk first if over MAX_INPUT_DIM)
+        with span("blob_put"):
+            await run_in_threadpool(ingest.store_input, file.file, info, store, input_key)
+
+        job = new_job(task_id, chat_id, input_key=input_key, content_hash=digest, tier=tier, trace_id=trace_id)
+        await run_in_threadpool(scheduler.enqueue if SCHEDULER_ENABLED else submit_job, job, queue_name)
+    except Exception as e:
+        # Nobody will finish this job, so tell anyone who joined it that it failed
+        await run_in_threadpool(deliver_to_waiters, digest, None)
+        await run_in_threadpool(store.delete, input_key)
+        if isinstance(e, scheduler.QueueFull):
+            raise HTTPException(status_code=429, detail="Too many images waiting. Please wait for your earlier ones.")
+        raise
 
     return {
         "status": "queued",
-        "task_id": task.id,
+        "task_id": task_id,
+        "tier": tier,
+        "eta_seconds": eta["eta_seconds"],
+        "queue_depth": eta["queue_depth"],
         "message": f"Image queued in the {queue_name} queue"
     }
 
+@router.post(
+    "/upscale/album",
+    summary="Upscale an album",
+    description="Upload 2-10 JPEG or PNG images (a Telegram media group) and queue them as one job. "
+                "The results are sent back to the chat as one album.",
+    response_description="Returns a task ID for the whole album",
+    responses={
+        200: {"description": "Album queued successfully"},
+        400: {"description": "Wrong number of images, not a JPEG/PNG image, or invalid model tier"},
+        413: {"description": "Image file or dimensions too large"},
+        429: {"description": "Too many images from this user waiting"},
+        503: {"description": "Free queue is full; retry after the Retry-After header"},
+        500: {"description": "Internal server error"},
+    }
+)
+async def upscale_album_endpoint(
+    files: List[UploadFile] = File(..., description="The images to upscale, in album order"),
+    chat_id: str = Form(..., description="Telegram chat ID to send the album back to"),
+    job_id: Optional[str] = Form(None, description="Trace id assigned by the caller; tags the job's logs and spans"),
+    tier: Optional[str] = Form(None, description="Model tier (full, light, x2); chosen from the user type if omitted")
+):
+    if not 2 <= len(files) <= ALBUM_MAX_IMAGES:
+        raise HTTPException(status_code=400, detail=f"❌ An album has 2 to {ALBUM_MAX_IMAGES} images.")
+    task_id = uuid.uuid4().hex
+    trace_id = _trace_id(job_id, task_id)
+    with job_context(trace_id):
+        return await _queue_album(files, chat_id, task_id, trace_id, tier)
+
+async def _queue_album(files, chat_id, task_id, trace_id, requested_tier):
+    infos = [await _probe(file) for file in files]
+
+    with span("db"):
+        user_data = await get_user_generations(int(chat_id))
+    user_is_vip = user_data and user_data["vip_tokens"] > 0
+    queue_name = "vip" if user_is_vip else "free"
+
+    # One model for the whole album, picked by its largest image
+    largest = max(infos, key=lambda info: info["width"] * info["height"])
+    try:
+        tier = resolve_tier(requested_tier, user_is_vip, (largest["width"], largest["height"]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Albums skip the result cache and coalescing: those resend single photos by file_id
+    tiles = sum(admission.estimate_tiles(info["width"], info["height"], tier) for info in infos)
+    eta = await _admit(queue_name, tier, tiles)
+
+    input_keys = [f"input_{task_id}_{i}.jpg" for i in range(len(files))]
+    try:
+        with span("blob_put"):
+            for file, info, key in zip(files, infos, input_keys):
+                await run_in_threadpool(ingest.store_input, file.file, info, store, key)
+
+        job = new_album_job(task_id, chat_id, input_keys, tier=tier, trace_id=trace_id)
+        await run_in_threadpool(scheduler.enqueue if SCHEDULER_ENABLED else submit_job, job, queue_name)
+    except Exception as e:
+        for key in input_keys:
+            await run_in_threadpool(store.delete, key)
+        if isinstance(e, scheduler.QueueFull):
+            raise HTTPException(status_code=429, detail="Too many images waiting. Please wait for your earlier ones.")
+        raise
+
+    return {
+        "status": "queued",
+        "task_id": task_id,
+        "tier": tier,
+        "images": len(files),
+        "eta_seconds": eta["eta_seconds"],
+        "queue_depth": eta["queue_depth"],
+        "message": f"Album of {len(files)} images queued in the {queue_name} queue"
+    }
+
 @router.get(
     "/result/{task_id}",
     summary="Check upscale result by task ID",
@@ -89,10 +278,9 @@ def get_upscale_result(task_id: str, background_tasks: BackgroundTasks):
         return {"status": "pending"}
 
     elif result.state == "SUCCESS":
-        output_path = result.result
-        if output_path and os.path.exists(output_path):
-            background_tasks.add_task(delete_file, output_path)
-            return FileResponse(output_path, media_type="image/jpeg", filename="upscaled.jpg")
+        output_key = result.result
+        if output_key and store.exists(output_key):
+            return _stream_result(output_key, background_tasks)
         return {"status": "done", "error": "file_missing"}
 
     elif result.state == "FAILURE":
@@ -100,9 +288,76 @@ def get_upscale_result(task_id: str, background_tasks: BackgroundTasks):
 
     return {"status": result.state.lower()}
 
-def delete_file(path: str):
+@router.get(
+    "/result/{task_id}/wait",
+    summary="Wait for an upscale result",
+    description="Long-poll: hold the request until the task finishes (or `timeout` seconds pass), "
+                "then stream the upscaled image. Notified through Redis pub/sub, not by polling Celery.",
+    responses={
+        200: {"description": "Upscaled image, or the task's status if it isn't finished"},
+    }
+)
+async def wait_for_result(
+    task_id: str,
+    background_tasks: BackgroundTasks,
+    timeout: float = Query(30, ge=0, le=LONG_POLL_MAX, description="Seconds to wait before answering pending")
+):
+    event = await job_events.wait(task_id, timeout)
+
+    if event is None or event["status"] not in job_events.TERMINAL:
+        return {"status": "pending", "stage": event and event.get("stage")}
+    if event["status"] == "failed":
+        return {"status": "failed", "error": event.get("error")}
+
+    output_key = event.get("output_key")
+    if output_key and await run_in_threadpool(store.exists, output_key):
+        return _stream_result(output_key, background_tasks)
+    # Cached results and albums are only sent on Telegram, so there is no file to download
+    return {"status": "done", "error": "file_missing"}
+
+@router.get(
+    "/result/{task_id}/events",
+    summary="Stream task progress",
+    description="Server-Sent Events: one `progress` event per finished stage, then `done` "
+                "(with a `result_url` to download from) or `failed`. Ends with `timeout` if the task "
+                "doesn't finish in time.",
+    responses={
+        200: {"description": "text/event-stream of task events"},
+    }
+)
+async def result_events(task_id: str):
+    async def stream():
+        async with aclosing(job_events.events(task_id, SSE_TIMEOUT, heartbeat=SSE_HEARTBEAT)) as events:
+            async for event in events:
+                if event is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                status = event["status"]
+                payload = {k: v for k, v in event.items() if k != "output_key"}
+                if status == "done" and event.get("output_key"):
+                    payload["result_url"] = f"/result/{task_id}/wait"
+                yield f"event: {status}\ndata: {json.dumps(payload)}\n\n"
+                if status in job_events.TERMINAL:
+                    return
+        yield f"event: timeout\ndata: {json.dumps({'job_id': task_id})}\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def _stream_result(output_key, background_tasks):
+    """Stream the result from the blob store in chunks, deleting it once sent."""
+    background_tasks.add_task(delete_blob, output_key)
+    return StreamingResponse(
+        store.iter_chunks(output_key),
+        media_type="image/jpeg",
+        headers={"Content-Disposition": 'attachment; filename="upscaled.jpg"'}
+    )
+
+def delete_blob(key: str):
     try:
-        if os.path.exists(path):
-            os.remove(path)
+        store.delete(key)
     except Exception as e:
-        print(f"[WARN] Failed to delete {path}: {e}")
+        print(f"[WARN] Failed to delete {key}: {e}")
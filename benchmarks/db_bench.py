@@ -0,0 +1,158 @@
+# benchmarks/db_bench.py
+# Compares the old multi-round-trip token/registration SQL with core/queries.py.
+# Runs in a throwaway schema on the database from .env, so the real users table is untouched.
+#
+#   python -m benchmarks.db_bench --iterations 2000 --threads 8
+import argparse
+import os
+import sys
+import threading
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import psycopg2
+
+from core import queries
+from core.db import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT
+
+SCHEMA = f"bench_{os.getpid()}"
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=DB_NAME, user=DB_USER, password=DB_PASSWORD, host=DB_HOST, port=DB_PORT,
+        options=f"-c search_path={SCHEMA}"
+    )
+
+
+def setup(users):
+    conn = connect()
+    with conn, conn.cursor() as cur:
+        cur.execute(f"CREATE SCHEMA {SCHEMA}")
+        cur.execute(f"""
+            CREATE TABLE {SCHEMA}.users (
+                telegram_id BIGINT PRIMARY KEY,
+                referrer_id BIGINT,
+                free_tokens INTEGER NOT NULL DEFAULT 0,
+                vip_tokens INTEGER NOT NULL DEFAULT 0,
+                referral_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cur.execute(f"CREATE INDEX ON {SCHEMA}.users (referrer_id)")
+        cur.execute(f"""
+            INSERT INTO {SCHEMA}.users (telegram_id, referrer_id, free_tokens, vip_tokens)
+            SELECT g, CASE WHEN g > 1 THEN g / 2 END, 1000000, g %% 2 * 1000000
+            FROM generate_series(1, %s) AS g
+        """, (users,))
+    conn.close()
+
+
+def teardown():
+    conn = connect()
+    with conn, conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+    conn.close()
+
+
+# Pre-rewrite implementations, kept here only as the baseline
+def legacy_decrement(cur, telegram_id):
+    cur.execute("SELECT vip_tokens, free_tokens FROM users WHERE telegram_id = %s", (telegram_id,))
+    vip, free = cur.fetchone()
+    if vip > 0:
+        cur.execute("UPDATE users SET vip_tokens = vip_tokens - 1 WHERE telegram_id = %s", (telegram_id,))
+    elif free > 0:
+        cur.execute("UPDATE users SET free_tokens = free_tokens - 1 WHERE telegram_id = %s", (telegram_id,))
+
+
+def legacy_register(cur, telegram_id, referrer_id):
+    cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+    if cur.fetchone() is None:
+        cur.execute("SELECT * FROM users WHERE telegram_id = %s", (referrer_id,))
+        if cur.fetchone():
+            cur.execute("INSERT INTO users (telegram_id, referrer_id, free_tokens) VALUES (%s, %s, 2)",
+                        (telegram_id, referrer_id))
+            cur.execute("UPDATE users SET free_tokens = free_tokens + 1 WHERE telegram_id = %s", (referrer_id,))
+
+
+def legacy_referral_count(cur, telegram_id):
+    cur.execute("SELECT COUNT(*) FROM users WHERE referrer_id = %s", (telegram_id,))
+    cur.fetchone()
+
+
+def new_decrement(cur, telegram_id):
+    cur.execute(queries.DECREMENT_GENERATION, {"telegram_id": telegram_id})
+    cur.fetchone()
+
+
+def new_register(cur, telegram_id, referrer_id):
+    cur.execute(queries.REGISTER_USER, {"telegram_id": telegram_id, "referrer_id": referrer_id})
+    cur.fetchone()
+
+
+def new_referral_count(cur, telegram_id):
+    cur.execute(queries.GET_REFERRAL_COUNT, {"telegram_id": telegram_id})
+    cur.fetchone()
+
+
+def run(name, fn, iterations, threads, users, id_offset=0):
+    """Run fn(cur, i) across threads, one transaction per call; returns ops/s and p50/p99 latency."""
+    latencies = []
+    lock = threading.Lock()
+    per_thread = iterations // threads
+
+    def worker(index):
+        conn = connect()
+        local = []
+        with conn.cursor() as cur:
+            for i in range(per_thread):
+                telegram_id = id_offset + (index * per_thread + i) % users + 1
+                start = time.perf_counter()
+                fn(cur, telegram_id)
+                conn.commit()
+                local.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    start = time.perf_counter()
+    pool = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    result = {
+        "name": name,
+        "ops_per_s": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+    print(f"{name:<28} {result['ops_per_s']:>9.0f} ops/s   p50 {result['p50_ms']:.2f} ms   p99 {result['p99_ms']:.2f} ms")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    setup(args.users)
+    try:
+        n, t, u = args.iterations, args.threads, args.users
+        run("decrement (legacy)", legacy_decrement, n, t, u)
+        run("decrement (single stmt)", new_decrement, n, t, u)
+        run("referral count (legacy)", legacy_referral_count, n, t, u)
+        run("referral count (counter)", new_referral_count, n, t, u)
+        # New ids above the seeded range so every call registers a fresh user
+        run("register (legacy)", lambda cur, i: legacy_register(cur, i, i - u), n, t, u, id_offset=u)
+        run("register (single stmt)", lambda cur, i: new_register(cur, i, i - 2 * u), n, t, u, id_offset=2 * u)
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
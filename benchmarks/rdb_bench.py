@@ -0,0 +1,92 @@
+# benchmarks/rdb_bench.py
+# Compares the torch.cat RRDB trunk with the fused in-place one (RRDBNet.run_trunk),
+# and with channels_last activations (which use the cat trunk), on random weights.
+# Also checks that each variant loads the same state_dict and matches the original output.
+#
+#   python -m benchmarks.rdb_bench --tiles 128,256 --batch 1,4 --threads 8
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import torch
+
+from core.bsrgan.rrdbnet_arch import RRDBNet
+
+VARIANTS = ("cat", "fused", "channels_last")
+
+
+def build_models(blocks):
+    torch.manual_seed(0)
+    reference = RRDBNet(nb=blocks, fused=False).eval()
+    state_dict = reference.state_dict()
+
+    models = {"cat": reference}
+    for name in VARIANTS[1:]:
+        model = RRDBNet(nb=blocks, fused=True)
+        model.load_state_dict(state_dict, strict=True)
+        model.eval()
+        if name == "channels_last":
+            model.use_channels_last()
+        models[name] = model
+    return models
+
+
+def time_it(fn, repeat):
+    fn()  # warm-up
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return statistics.median(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fused RRDB trunk against torch.cat")
+    parser.add_argument("--tiles", default="128,256")
+    parser.add_argument("--batch", default="1,4")
+    parser.add_argument("--blocks", type=int, default=23)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Max abs diff allowed vs the original")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    models = build_models(args.blocks)
+
+    results = {}
+    failed = False
+    for tile in (int(t) for t in args.tiles.split(",")):
+        for batch in (int(b) for b in args.batch.split(",")):
+            x = torch.rand(batch, 3, tile, tile)
+            with torch.no_grad():
+                expected = models["cat"](x)
+                for name in VARIANTS:
+                    model = models[name]
+                    diff = (model(x).float() - expected).abs().max().item()
+                    seconds = time_it(lambda: model(x), args.repeat)
+
+                    key = f"tile={tile}/batch={batch}/{name}"
+                    results[key] = {"median_s": seconds, "max_abs_diff": diff}
+                    speedup = results[f"tile={tile}/batch={batch}/cat"]["median_s"] / seconds
+                    status = "ok" if diff <= args.tolerance else "MISMATCH"
+                    failed |= diff > args.tolerance
+                    print(f"  tile={tile:<4} batch={batch:<3} {name:<20} {seconds * 1000:9.1f} ms  "
+                          f"x{speedup:4.2f}  max diff {diff:.1e} {status}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+    if failed:
+        print(f"[❌ MISMATCH] Fused output differs from the original by more than {args.tolerance:.0e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# benchmarks/scheduler_sim.py
+# Discrete-event simulation of queue wait times per tier under synthetic load.
+# Compares today's routing (workers alternate between the vip and free queues),
+# strict VIP priority, and services.scheduler.FairPolicy with per-user caps.
+#
+#   python -m benchmarks.scheduler_sim --workers 4 --load 0.95 --duration 3600
+import argparse
+import heapq
+import json
+import os
+import random
+import sys
+from collections import defaultdict, deque
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.scheduler import FairPolicy, MAX_INFLIGHT_PER_USER, TIERS
+
+
+def make_arrivals(args, rng):
+    """(time, tier, user, service_seconds) sorted by time, including one album flood."""
+    rate = args.load * args.workers / args.service_mean
+    vip_rate = rate * args.vip_share
+    free_rate = rate - vip_rate
+    jobs = []
+    for tier, tier_rate, users in (("vip", vip_rate, 50), ("free", free_rate, 500)):
+        t = 0.0
+        while True:
+            t += rng.expovariate(tier_rate)
+            if t > args.duration:
+                break
+            jobs.append((t, tier, f"{tier}-{rng.randrange(users)}"))
+
+    # One free user sends a large album at once
+    flood_at = args.duration / 3
+    jobs += [(flood_at, "free", "flooder")] * args.flood
+
+    sigma = 0.5
+    mu = -sigma ** 2 / 2
+    return sorted((t, tier, user, args.service_mean * rng.lognormvariate(mu, sigma)) for t, tier, user in jobs)
+
+
+class RoundRobin:
+    """Celery worker consuming -Q vip,free: alternates between non-empty queues."""
+    user_cap = None
+
+    def __init__(self):
+        self.last = None
+
+    def pick(self, queues, now):
+        ready = [tier for tier in TIERS if queues[tier]]
+        if not ready:
+            return None
+        others = [tier for tier in ready if tier != self.last]
+        self.last = (others or ready)[0]
+        return self.last
+
+
+class StrictPriority:
+    user_cap = None
+
+    def pick(self, queues, now):
+        return next((tier for tier in TIERS if queues[tier]), None)
+
+
+class Fair:
+    user_cap = MAX_INFLIGHT_PER_USER
+
+    def __init__(self):
+        self.policy = FairPolicy()
+        self.vtimes = {}
+
+    def pick(self, queues, now):
+        waits = {tier: now - queues[tier][0][0] for tier in TIERS if queues[tier]}
+        return self.policy.choose(waits, self.vtimes)
+
+    def dispatched(self, tier):
+        self.policy.charge(tier, self.vtimes)
+
+
+def simulate(arrivals, scheduler, workers):
+    queues = {tier: deque() for tier in TIERS}
+    inflight = defaultdict(int)
+    waits = defaultdict(list)
+    events = [(t, 1, i) for i, (t, _, _, _) in enumerate(arrivals)]  # (time, kind, payload); 0 = finish
+    heapq.heapify(events)
+    idle = workers
+
+    def next_job(now):
+        # Try tiers in the scheduler's order, skipping users at their in-flight cap
+        tried = set()
+        while True:
+            visible = {tier: (q if tier not in tried else deque()) for tier, q in queues.items()}
+            tier = scheduler.pick(visible, now)
+            if tier is None:
+                return None
+            for job in queues[tier]:
+                if scheduler.user_cap is None or inflight[job[2]] < scheduler.user_cap:
+                    queues[tier].remove(job)
+                    if hasattr(scheduler, "dispatched"):
+                        scheduler.dispatched(tier)
+                    return job
+            tried.add(tier)
+
+    while events:
+        now, kind, payload = heapq.heappop(events)
+        if kind == 1:
+            t, tier, user, service = arrivals[payload]
+            queues[tier].append((t, tier, user, service))
+        else:
+            idle += 1
+            inflight[payload] -= 1
+
+        while idle:
+            job = next_job(now)
+            if job is None:
+                break
+            t, tier, user, service = job
+            idle -= 1
+            inflight[user] += 1
+            waits[tier].append(now - t)
+            if tier == "free":
+                waits["flooder" if user == "flooder" else "free (others)"].append(now - t)
+            heapq.heappush(events, (now + service, 0, user))
+    return waits
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate per-tier wait times for the upscale scheduler")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--load", type=float, default=0.95, help="Offered load as a fraction of capacity")
+    parser.add_argument("--vip-share", type=float, default=0.2)
+    parser.add_argument("--service-mean", type=float, default=6.0, help="Mean seconds per job")
+    parser.add_argument("--duration", type=float, default=3600.0)
+    parser.add_argument("--flood", type=int, default=40, help="Album size sent at once by one free user")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    arrivals = make_arrivals(args, random.Random(args.seed))
+    results = {}
+    for name, scheduler in (("round_robin", RoundRobin()), ("strict", StrictPriority()), ("fair", Fair())):
+        waits = simulate(arrivals, scheduler, args.workers)
+        results[name] = {
+            group: {"jobs": len(w), "p50_s": percentile(w, 0.5), "p99_s": percentile(w, 0.99)}
+            for group, w in sorted(waits.items())
+        }
+        print(f"\n== {name}")
+        for group, stats in results[name].items():
+            print(f"  {group:<16} n={stats['jobs']:<6} p50 {stats['p50_s']:8.1f}s   p99 {stats['p99_s']:8.1f}s")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
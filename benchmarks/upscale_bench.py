@@ -0,0 +1,243 @@
+# benchmarks/upscale_bench.py
+# Timing suite for the upscaling path. Uses randomly initialised RRDBNet weights,
+# so BSRGAN.pth is not needed (timings don't depend on the weight values).
+#
+#   python -m benchmarks.upscale_bench run --out results.json
+#   python -m benchmarks.upscale_bench run --sizes 256,512 --tiles 128,256 --threads 1,8 --precisions fp32,bf16
+#   python -m benchmarks.upscale_bench compare baseline.json results.json --threshold 0.10
+#
+# Suites:
+#   forward  - one RRDBNet.forward per tile size / thread count / precision
+#   upscale  - core.upscale_fn.upscale_image end to end (decode, tiles, assembly, JPEG)
+#   celery   - decode -> infer -> encode pipeline tasks with an eager in-memory broker
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# The Celery suite must never reach a real broker, Redis or the shared blob directory
+os.environ["REDIS_BROKER_URL"] = "memory://"
+os.environ["REDIS_URL"] = "memory://"  # Not a Redis URL, so a stray app-data call fails instead of reaching .env's server
+os.environ["REDIS_RESULT_BACKEND"] = "cache+memory://"
+os.environ["BLOB_BACKEND"] = "local"
+os.environ["BLOB_LOCAL_DIR"] = tempfile.mkdtemp(prefix="upscale_bench_")
+os.environ["INFERENCE_SERVER_ADDRESS"] = ""
+
+import numpy as np
+import torch
+from PIL import Image
+
+from core import upscale_fn
+from core.bsrgan.rrdbnet_arch import RRDBNet
+from core.models import DEFAULT_TIER, INFERENCE_CHANNELS_LAST, ModelSpec, ResidentModel, registry
+from core.precision import prepare_model, load_calibration_tiles
+
+SUITES = ("forward", "upscale", "celery")
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def str_list(value):
+    return [v for v in value.split(",") if v]
+
+
+def use_random_model(precision, blocks):
+    """Install a randomly initialised model as the default tier, in place of load_model()."""
+    torch.manual_seed(0)
+    model = RRDBNet(in_nc=3, out_nc=3, nf=64, nb=blocks, sf=4).eval().to(upscale_fn.device)
+    if INFERENCE_CHANNELS_LAST and upscale_fn.device.type == "cpu":
+        model.use_channels_last()
+    if precision != "fp32":
+        model = prepare_model(model, precision, load_calibration_tiles(count=4, size=64))
+    spec = ModelSpec(DEFAULT_TIER, "", nb=blocks, sf=4)
+    registry.install(DEFAULT_TIER, ResidentModel(spec, model, precision))
+    return model
+
+
+def make_image(size, seed=0):
+    """Noise over smooth gradients, JPEG-encoded like a user photo."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size] / size
+    base = np.stack([xx, yy, (xx + yy) / 2], axis=-1) * 200
+    pixels = np.clip(base + rng.normal(0, 20, base.shape), 0, 255).astype(np.uint8)
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def time_it(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {"median_s": statistics.median(runs), "min_s": min(runs), "runs": len(runs)}
+
+
+def bench_forward(args, results):
+    for precision in args.precisions:
+        model = use_random_model(precision, args.blocks)
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            for tile in args.tiles:
+                x = torch.rand(1, 3, tile, tile, device=upscale_fn.device)
+
+                def forward():
+                    with torch.no_grad():
+                        model(x)
+
+                stats = time_it(forward, args.repeat)
+                stats["mpix_per_s"] = tile * tile / 1e6 / stats["median_s"]
+                results[f"forward/tile={tile}/threads={threads}/{precision}"] = stats
+                print(f"  forward  tile={tile:<4} threads={threads:<3} {precision:<5} {stats['median_s'] * 1000:9.1f} ms")
+
+
+def bench_upscale(args, results):
+    for precision in args.precisions:
+        use_random_model(precision, args.blocks)
+        for threads in args.threads:
+            torch.set_num_threads(threads)
+            for size in args.sizes:
+                data = make_image(size)
+                for tile in args.tiles:
+                    for overlap in args.overlaps:
+                        def upscale():
+                            upscale_fn.upscale_image(io.BytesIO(data), io.BytesIO(), tile_size=tile, tile_overlap=overlap)
+
+                        stats = time_it(upscale, args.repeat)
+                        stats["mpix_per_s"] = size * size / 1e6 / stats["median_s"]
+                        key = f"upscale/size={size}/tile={tile}/overlap={overlap}/threads={threads}/{precision}"
+                        results[key] = stats
+                        print(f"  upscale  size={size:<5} tile={tile:<4} overlap={overlap:<3} threads={threads:<3} "
+                              f"{precision:<5} {stats['median_s']:8.2f} s")
+
+
+def bench_celery(args, results):
+    from celery import chain
+    from core.storage import get_blob_store
+    from services.celery_app import celery
+    from services import pipeline
+    from services.pipeline import decode_stage, infer_stage, encode_stage, new_job
+
+    celery.conf.task_always_eager = True
+    celery.conf.task_eager_propagates = True
+    # Job events and admission samples go to Redis; bench jobs must not show up in either
+    pipeline.job_events.publish = lambda *args, **kwargs: None
+    pipeline.admission.record_inference = lambda *args, **kwargs: None
+    store = get_blob_store()
+    use_random_model(args.precisions[0], args.blocks)
+    torch.set_num_threads(args.threads[-1])
+
+    for size in args.sizes:
+        data = make_image(size)
+        counter = iter(range(10 ** 9))
+
+        def run_jobs():
+            # deliver_stage is left out: it needs Postgres and the Telegram API
+            for _ in range(args.jobs):
+                job = new_job(f"bench{next(counter)}", 0, input_key=f"bench_in_{os.getpid()}")
+                store.put(job["input_key"], data)
+                job = chain(decode_stage.s(job), infer_stage.s(), encode_stage.s()).apply().get()
+                store.delete(job["output_key"])
+
+        stats = time_it(run_jobs, args.repeat)
+        stats["jobs_per_s"] = args.jobs / stats["median_s"]
+        results[f"celery/size={size}/jobs={args.jobs}/{args.precisions[0]}"] = stats
+        print(f"  celery   size={size:<5} jobs={args.jobs:<3} {stats['jobs_per_s']:8.2f} jobs/s")
+
+
+def run(args):
+    results = {}
+    suites = {"forward": bench_forward, "upscale": bench_upscale, "celery": bench_celery}
+    for name in args.suites:
+        print(f"== {name}")
+        suites[name](args, results)
+
+    report = {
+        "meta": {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "device": str(upscale_fn.device),
+            "blocks": args.blocks,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[💾 SAVED] {len(results)} results to {args.out}")
+
+
+def compare(args):
+    """Print the change per benchmark; exit 1 if any median got slower by more than the threshold."""
+    with open(args.baseline) as f:
+        baseline = json.load(f)["results"]
+    with open(args.current) as f:
+        current = json.load(f)["results"]
+
+    regressions = 0
+    for key in sorted(set(baseline) | set(current)):
+        if key not in baseline or key not in current:
+            print(f"  {'new' if key in current else 'gone':<10} {key}")
+            continue
+        change = current[key]["median_s"] / baseline[key]["median_s"] - 1
+        status = "ok"
+        if change > args.threshold:
+            status = "REGRESSED"
+            regressions += 1
+        elif change < -args.threshold:
+            status = "faster"
+        print(f"  {status:<10} {key:<70} {baseline[key]['median_s']:9.4f}s -> {current[key]['median_s']:9.4f}s "
+              f"({change:+.1%})")
+
+    if regressions:
+        print(f"[❌ REGRESSION] {regressions} benchmark(s) slower by more than {args.threshold:.0%}")
+        sys.exit(1)
+    print("[✅ OK] No regressions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the upscaling path")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="Run benchmarks and write a JSON report")
+    p.add_argument("--suites", type=str_list, default=list(SUITES), help=f"Comma-separated subset of {SUITES}")
+    p.add_argument("--sizes", type=int_list, default=[256, 512], help="Input side lengths in pixels")
+    p.add_argument("--tiles", type=int_list, default=[128, 256])
+    p.add_argument("--overlaps", type=int_list, default=[8])
+    p.add_argument("--threads", type=int_list, default=sorted({1, os.cpu_count() or 1}))
+    p.add_argument("--precisions", type=str_list, default=["fp32"])
+    p.add_argument("--blocks", type=int, default=23, help="RRDB blocks (23 in BSRGAN; fewer for a quick run)")
+    p.add_argument("--jobs", type=int, default=4, help="Jobs per Celery throughput run")
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--out", default="benchmark_results.json")
+    p.set_defaults(func=run)
+
+    p = sub.add_parser("compare", help="Compare a run against a saved baseline")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.add_argument("--threshold", type=float, default=0.10, help="Allowed slowdown before flagging, e.g. 0.10")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    unknown = set(getattr(args, "suites", [])) - set(SUITES)
+    if unknown:
+        parser.error(f"unknown suites: {', '.join(sorted(unknown))}")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,49 @@
+import asyncio
 import os; 
 from dotenv import load_dotenv
 
 from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler, PreCheckoutQueryHandler, filters
-from bot.handlers import handle_image, unknown
+from bot.handlers import handle_image, unknown, open_http_session, close_http_session
+from bot.update_processor import ChatOrderedUpdateProcessor
+from bot.webhook import WEBHOOK_URL, run_webhook
 from bot.commands import start, profile, refer, bots, terms, paysupport, help_command, set_menu_commands, MENU_COMMANDS
+from core.db_async import open_pool, close_pool
+from core.metrics import start_exporter
 from core.payments import purchase, handle_purchase_callback, pre_checkout_query, successful_payment_handler
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")  # e.g. a local Bot API server or a test stand-in
 
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN not found. Please set it in your .env file.")
 
-if __name__ == "__main__":
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
+async def post_init(app):
     # Set persistent menu commands after bot initializes
-    app.post_init = set_menu_commands
+    await set_menu_commands(app)
+    await open_http_session(app)
+    await open_pool()
+    start_exporter()  # Download and API-submit spans, if METRICS_PORT is set
+
+async def post_shutdown(app):
+    await close_http_session(app)
+    await close_pool()
+
+if __name__ == "__main__":
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        # Different chats are handled concurrently; each chat's updates stay in order
+        .concurrent_updates(ChatOrderedUpdateProcessor())
+    )
+    if TELEGRAM_API_URL:
+        api_url = TELEGRAM_API_URL.rstrip("/")
+        builder = builder.base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot")
+    if WEBHOOK_URL:
+        builder = builder.updater(None)  # Updates arrive through bot/webhook.py instead
+    app = builder.build()
 
     # Register all bot commands
     app.add_handler(CommandHandler("start", start))
@@ -40,4 +67,7 @@ if __name__ == "__main__":
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, unknown))
 
     # Run bot
-    app.run_polling()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        app.run_polling()
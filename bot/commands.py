@@ -1,7 +1,7 @@
 import os
 from telegram import Update, BotCommand
 from telegram.ext import ContextTypes
-from core.db import register_user, get_user_generations, get_referral_count
+from core.db_async import register_user, get_user_generations, get_referral_count
 
 # Define menu commands
 MENU_COMMANDS = [
@@ -34,7 +34,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # /profile command
 async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     telegram_id = update.effective_user.id
-    user = get_user_generations(telegram_id)
+    user = await get_user_generations(telegram_id)
 
     if not user:
         await update.message.reply_text("❌ You are not registered. Please use /start first.")
@@ -49,7 +49,7 @@ async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     free_gen = user["free_tokens"]
     vip_gen = user["vip_tokens"]
-    referral_count = get_referral_count(telegram_id)
+    referral_count = await get_referral_count(telegram_id)
 
     await update.message.reply_text(
         f"👋 Hello, *{user_name}*!\n\n"
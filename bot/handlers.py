@@ -1,15 +1,44 @@
 # bot/handlers.py
+import asyncio
 import os
 import uuid
+
 import aiohttp
 
 from telegram import Update
 from telegram.error import Forbidden
 from telegram.ext import ContextTypes
 
-from core.db import get_user_generations, decrement_generation
+from core.db_async import get_user_generations
+from core.metrics import job_context, span
 
 FASTAPI_URL = "http://localhost:8000/upscale"
+ALBUM_URL = f"{FASTAPI_URL}/album"
+HTTP_POOL_SIZE = 100  # Max simultaneous connections to the API
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.5"))  # Seconds to wait for the rest of a media group
+
+async def open_http_session(app):
+    """Create the pooled HTTP session shared by every handler for the app's lifetime."""
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=60)
+    app.bot_data["http_session"] = aiohttp.ClientSession(connector=connector)
+
+async def close_http_session(app):
+    session = app.bot_data.pop("http_session", None)
+    if session is not None:
+        await session.close()
+
+def format_wait(seconds):
+    """Human wording for an ETA in seconds."""
+    if seconds < 60:
+        return "less than a minute"
+    minutes = round(seconds / 60)
+    return f"about {minutes} minute{'s' if minutes != 1 else ''}"
+
+def get_http_session(context: ContextTypes.DEFAULT_TYPE) -> aiohttp.ClientSession:
+    session = context.application.bot_data.get("http_session")
+    if session is None or session.closed:
+        raise RuntimeError("HTTP session not initialised; open_http_session must run in post_init")
+    return session
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❓ I only respond to images. Please send me a photo.")
@@ -21,18 +50,15 @@ async def safe_reply(message, text, **kwargs):
     except Forbidden:
         print(f"[WARN] Bot blocked by user {message.chat_id}")
 
-async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    telegram_id = update.effective_user.id
-    user = get_user_generations(telegram_id)
+async def _check_tokens(update):
+    """The user's balances, or None after telling them why they can't upscale."""
+    user = await get_user_generations(update.effective_user.id)
 
     if not user:
         await safe_reply(update.message, "❌ You are not registered. Please use /start first.")
-        return
+        return None
 
-    free_gen = user["free_tokens"]
-    vip_gen = user["vip_tokens"]
-
-    if free_gen <= 0 and vip_gen <= 0:
+    if user["free_tokens"] <= 0 and user["vip_tokens"] <= 0:
         await safe_reply(
             update.message,
             "⚠️ You've used all your available *Tokens*.\n\n"
@@ -40,38 +66,72 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "💡 You can also /refer friends to earn free *Tokens*!",
             parse_mode="HTML"
         )
+        return None
+    return user
+
+async def _reply_busy(message, resp):
+    # Free queue is shedding load; nothing was queued or charged
+    await safe_reply(
+        message,
+        "🚦 The free queue is very busy right now. Please try again in "
+        f"{format_wait(int(resp.headers.get('Retry-After', '60')))}.\n\n"
+        "💎 VIP requests are always accepted — see /purchase."
+    )
+
+def _token_note(free_gen, vip_gen):
+    if vip_gen > 0:
+        return "💎 Using *VIP Token* — your request will be prioritized for faster processing!"
+    elif free_gen > 0:
+        return "🎁 Using *Free Token*."
+    return ""
+
+async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Photos of an album arrive as separate updates; collect them into one job
+    if update.message.media_group_id:
+        _collect_album(update, context)
+        return
+
+    user = await _check_tokens(update)
+    if not user:
         return
+    free_gen = user["free_tokens"]
+    vip_gen = user["vip_tokens"]
 
     await safe_reply(update.message, "🔄 Uploading image and queuing for upscaling...")
 
-    os.makedirs("temp", exist_ok=True)
-    unique_id = f"{telegram_id}_{update.message.message_id}_{uuid.uuid4().hex}"
-    input_path = f"temp/input_{unique_id}.jpg"
+    # One id per upload, carried through the API and every pipeline stage
+    job_id = uuid.uuid4().hex
+    with job_context(job_id):
+        await _submit_image(update, context, job_id, free_gen, vip_gen)
 
+async def _submit_image(update, context, job_id, free_gen, vip_gen):
     try:
-        # Step 1: Download image
+        # Step 1: Download image into memory
         photo = update.message.photo[-1]
-        file = await photo.get_file()
-        await file.download_to_drive(input_path)
-
-        # Step 2: Send image + chat_id to FastAPI
-        async with aiohttp.ClientSession() as session:
-            with open(input_path, "rb") as image_file:
-                form_data = aiohttp.FormData()
-                form_data.add_field("file", image_file, filename="upload.jpg", content_type="image/jpeg")
-                form_data.add_field("chat_id", str(update.effective_chat.id))  # Pass chat_id
-
-                async with session.post(FASTAPI_URL, data=form_data) as resp:
-                    if resp.status != 200:
-                        raise Exception(f"FastAPI error: {await resp.text()}")
+        with span("download"):
+            file = await photo.get_file()
+            image_bytes = bytes(await file.download_as_bytearray())
+
+        # Step 2: Send image + chat_id to FastAPI over the shared session
+        form_data = aiohttp.FormData()
+        form_data.add_field("file", image_bytes, filename="upload.jpg", content_type="image/jpeg")
+        form_data.add_field("chat_id", str(update.effective_chat.id))  # Pass chat_id
+        form_data.add_field("job_id", job_id)
+
+        with span("api_submit"):
+            async with get_http_session(context).post(FASTAPI_URL, data=form_data) as resp:
+                if resp.status == 503:
+                    await _reply_busy(update.message, resp)
+                    return
+                if resp.status != 200:
+                    raise Exception(f"FastAPI error: {await resp.text()}")
+                result = await resp.json()
 
         # Build single combined message
-        msg = "✅ Image queued successfully. You’ll receive the result here when it’s ready.\n\n"
-
-        if vip_gen > 0:
-            msg += "💎 Using *VIP Token* — your request will be prioritized for faster processing!"
-        elif free_gen > 0:
-            msg += "🎁 Using *Free Token*."
+        msg = "✅ Image queued successfully. You’ll receive the result here when it’s ready.\n"
+        if result.get("eta_seconds") is not None:
+            msg += f"⏳ Expected wait: {format_wait(result['eta_seconds'])}.\n"
+        msg += "\n" + _token_note(free_gen, vip_gen)
 
         await safe_reply(update.message, msg, parse_mode="Markdown")
         # ⚠️ DO NOT decrement generation now — let Celery do it after successful processing
@@ -79,9 +139,81 @@ async def handle_image(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except Exception as e:
         await safe_reply(update.message, f"❌ Failed to queue image: {str(e)}")
 
-    finally:
-        try:
-            if os.path.exists(input_path):
-                os.remove(input_path)
-        except Exception as cleanup_err:
-            print(f"[WARN] Cleanup failed: {cleanup_err}")
+def _collect_album(update, context):
+    """Buffer a media group's photos; the group is submitted ALBUM_WINDOW after its last photo."""
+    albums = context.application.bot_data.setdefault("albums", {})
+    album = albums.setdefault(update.message.media_group_id, {"updates": [], "timer": None})
+    album["updates"].append(update)
+    if album["timer"]:
+        album["timer"].cancel()
+    album["timer"] = context.application.create_task(_flush_album(update.message.media_group_id, context))
+
+async def _flush_album(group_id, context):
+    await asyncio.sleep(ALBUM_WINDOW)
+    # Removed as soon as the window closes, so a late photo starts a new group instead of being lost
+    updates = context.application.bot_data["albums"].pop(group_id)["updates"]
+    updates.sort(key=lambda u: u.message.message_id)
+    first = updates[0]
+
+    user = await _check_tokens(first)
+    if not user:
+        return
+    free_gen = user["free_tokens"]
+    vip_gen = user["vip_tokens"]
+
+    # Only upscale as many photos as the user has tokens for
+    available = max(free_gen, 0) + max(vip_gen, 0)
+    if available < len(updates):
+        await safe_reply(
+            first.message,
+            f"⚠️ You have {available} token{'s' if available != 1 else ''} left, "
+            f"so only the first {available} of {len(updates)} photos will be upscaled."
+        )
+        updates = updates[:available]
+
+    job_id = uuid.uuid4().hex
+    with job_context(job_id):
+        if len(updates) == 1:
+            await safe_reply(first.message, "🔄 Uploading image and queuing for upscaling...")
+            await _submit_image(first, context, job_id, free_gen, vip_gen)
+        else:
+            await safe_reply(first.message, f"🔄 Uploading {len(updates)} images and queuing them as one album...")
+            await _submit_album(updates, context, job_id, free_gen, vip_gen)
+
+async def _download(photo):
+    file = await photo.get_file()
+    return bytes(await file.download_as_bytearray())
+
+async def _submit_album(updates, context, job_id, free_gen, vip_gen):
+    message = updates[0].message
+    try:
+        # Step 1: Download every photo at once
+        with span("download"):
+            images = await asyncio.gather(*(_download(u.message.photo[-1]) for u in updates))
+
+        # Step 2: One request for the whole album
+        form_data = aiohttp.FormData()
+        for i, image_bytes in enumerate(images):
+            form_data.add_field("files", image_bytes, filename=f"upload_{i}.jpg", content_type="image/jpeg")
+        form_data.add_field("chat_id", str(message.chat_id))
+        form_data.add_field("job_id", job_id)
+
+        with span("api_submit"):
+            async with get_http_session(context).post(ALBUM_URL, data=form_data) as resp:
+                if resp.status == 503:
+                    await _reply_busy(message, resp)
+                    return
+                if resp.status != 200:
+                    raise Exception(f"FastAPI error: {await resp.text()}")
+                result = await resp.json()
+
+        msg = f"✅ {len(images)} images queued as one album. You’ll receive them here together when they’re ready.\n"
+        if result.get("eta_seconds") is not None:
+            msg += f"⏳ Expected wait: {format_wait(result['eta_seconds'])}.\n"
+        msg += "\n" + _token_note(free_gen, vip_gen)
+
+        await safe_reply(message, msg, parse_mode="Markdown")
+        # Tokens for the whole album are charged in one go when it is delivered
+
+    except Exception as e:
+        await safe_reply(message, f"❌ Failed to queue album: {str(e)}")
@@ -0,0 +1,60 @@
+# bot/update_processor.py
+# Concurrent update handling that keeps each chat's updates in order.
+#
+# PTB's default handles one update at a time, so a slow photo upload delays every other
+# user's /start. With this processor up to BOT_CONCURRENT_UPDATES updates run at once,
+# but updates from the same chat still run one after another, in arrival order.
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Bounded concurrency across chats, strict ordering within one chat."""
+
+    def __init__(self, max_concurrent_updates=BOT_CONCURRENT_UPDATES):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # chat key -> [lock, updates holding or waiting for it]
+
+    @staticmethod
+    def _chat_key(update):
+        if not isinstance(update, Update):
+            return None
+        # Pre-checkout queries have no chat; order them with the rest of the user's updates
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return None
+
+    async def process_update(self, update, coroutine):
+        key = self._chat_key(update)
+        if key is None:
+            await super().process_update(update, coroutine)
+            return
+
+        # The chat lock is taken before a concurrency slot, so one chat's backlog
+        # waits without holding slots other chats could use. asyncio.Lock wakes
+        # waiters first-come first-served, which keeps arrival order.
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._chats[key]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
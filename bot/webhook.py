@@ -0,0 +1,79 @@
+# bot/webhook.py
+# Webhook mode: Telegram POSTs updates to a small Starlette app served by uvicorn,
+# which puts them on the Application's update queue.
+#
+# Run it behind a TLS-terminating proxy that forwards WEBHOOK_URL to WEBHOOK_LISTEN:WEBHOOK_PORT.
+# For local testing, point TELEGRAM_API_URL at a stand-in Bot API server and POST update
+# JSON to http://WEBHOOK_LISTEN:WEBHOOK_PORT{WEBHOOK_PATH} with the secret header.
+import hmac
+import os
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public base URL; empty means long polling
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Required; sent back by Telegram in X-Telegram-Bot-Api-Secret-Token
+
+
+def build_webhook_app(application):
+    """ASGI app that feeds POSTed updates to `application`."""
+
+    async def receive_update(request: Request):
+        # Updates are trusted as coming from Telegram (payments credit tokens), so always check the secret
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not WEBHOOK_SECRET or not hmac.compare_digest(token.encode(), WEBHOOK_SECRET.encode()):
+            return Response(status_code=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except (ValueError, TypeError, KeyError):
+            return Response(status_code=400)
+        # Answer right away; the update is processed by the Application's update processor
+        await application.update_queue.put(update)
+        return Response()
+
+    async def health(_: Request):
+        return PlainTextResponse("ok")
+
+    return Starlette(routes=[
+        Route(WEBHOOK_PATH, receive_update, methods=["POST"]),
+        Route("/healthcheck", health, methods=["GET"]),
+    ])
+
+
+async def run_webhook(application):
+    """Register the webhook with Telegram and serve it until uvicorn is stopped (Ctrl+C / SIGTERM)."""
+    if not WEBHOOK_SECRET:
+        raise ValueError("❌ WEBHOOK_SECRET not set. Webhook mode needs it so forged updates can be rejected.")
+
+    server = uvicorn.Server(uvicorn.Config(
+        build_webhook_app(application),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        log_level="warning",
+        use_colors=False,
+    ))
+
+    # Application.run_* would call these hooks; a custom server has to do it itself
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        await application.start()
+        print(f"[🌐 WEBHOOK] Listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
@@ -0,0 +1,59 @@
+# core/assembly.py
+import numpy as np
+import torch
+from PIL import Image
+
+
+class BandAssembler:
+    """
+    Blends upscaled tiles into a float accumulator that only spans one band of
+    output rows. Rows are converted to uint8 and written out as soon as no
+    remaining tile can overlap them, so the full-resolution float32 output
+    never exists in memory; only the uint8 image does.
+    """
+
+    def __init__(self, band_h, out_w, crop_h, crop_w, device):
+        self.band_h = band_h
+        self.crop_h = crop_h
+        self.crop_w = crop_w
+        self.top = 0  # Output row stored at acc[:, 0]
+
+        self.acc = torch.zeros((3, band_h, out_w), device=device)
+        self.wacc = torch.zeros((1, band_h, out_w), device=device)
+        self.buffer = np.empty((crop_h, crop_w, 3), dtype=np.uint8)
+
+    def add(self, sr_tile, weight, out_y, out_x):
+        """Accumulate one (3, oh, ow) tile weighted by its (1, oh, ow) blending mask."""
+        r = out_y - self.top
+        oh, ow = sr_tile.shape[1], sr_tile.shape[2]
+        self.acc[:, r:r+oh, out_x:out_x+ow] += sr_tile * weight
+        self.wacc[:, r:r+oh, out_x:out_x+ow] += weight
+
+    def advance(self, row):
+        """Finalize every output row above `row`; all remaining tiles start at or below it."""
+        n = row - self.top
+        if n <= 0:
+            return
+        self._write(n)
+
+        # Shift the still-open rows to the top of the band
+        keep = self.band_h - n
+        if keep > 0:
+            self.acc[:, :keep] = self.acc[:, n:].clone()
+            self.wacc[:, :keep] = self.wacc[:, n:].clone()
+        self.acc[:, max(keep, 0):] = 0
+        self.wacc[:, max(keep, 0):] = 0
+        self.top = row
+
+    def finish(self):
+        """Finalize the remaining rows and return the assembled image."""
+        self._write(self.band_h)
+        return Image.fromarray(self.buffer)
+
+    def _write(self, n):
+        n = min(n, self.band_h, self.crop_h - self.top)
+        if n <= 0:
+            return
+        rows = self.acc[:, :n, :self.crop_w] / self.wacc[:, :n, :self.crop_w].clamp_min(1e-8)
+        rows = rows.clamp(0, 1).mul(255).byte().permute(1, 2, 0).cpu().numpy()
+        self.buffer[self.top:self.top + n] = rows
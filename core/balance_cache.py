@@ -0,0 +1,199 @@
+# core/balance_cache.py
+# Read-through cache of users' token balances, shared by core/db.py and core/db_async.py.
+#
+# Two layers: a small in-process TTL dict (no I/O at all on a hit) and a Redis key
+# shared by every process. Writers delete the Redis key and publish the telegram_id on
+# INVALIDATE_CHANNEL so other processes drop their local copy; the next read refills it
+# from the database. Writers never SET a balance: two workers charging the same user can
+# finish out of commit order, and a blind SET could leave the older, higher balance cached.
+# Read-through fills use SET NX, and only a fill that won is kept locally.
+import os
+import threading
+import time
+
+import redis
+import redis.asyncio as aioredis
+
+BALANCE_REDIS_URL = os.getenv("BALANCE_REDIS_URL") or os.getenv("REDIS_BROKER_URL") or "redis://localhost:6379/0"
+BALANCE_LOCAL_TTL = float(os.getenv("BALANCE_LOCAL_TTL", "5"))  # Bound on staleness if an invalidation is missed
+BALANCE_REDIS_TTL = int(os.getenv("BALANCE_REDIS_TTL", "300"))
+BALANCE_LOCAL_MAX = 10000
+INVALIDATE_CHANNEL = "balance:invalidate"
+
+_local = {}
+_local_lock = threading.Lock()
+_client = None
+_async_client = None
+_subscriber_pid = None
+
+
+def _key(telegram_id):
+    return f"balance:{telegram_id}"
+
+
+def _encode(balance):
+    return f"{balance['free_tokens']},{balance['vip_tokens']}"
+
+
+def _decode(raw):
+    if not raw:
+        return None
+    free, vip = raw.decode().split(",")
+    return {"free_tokens": int(free), "vip_tokens": int(vip)}
+
+
+def _client_sync():
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(BALANCE_REDIS_URL)
+    return _client
+
+
+def _client_async():
+    global _async_client
+    if _async_client is None:
+        _async_client = aioredis.Redis.from_url(BALANCE_REDIS_URL)
+    return _async_client
+
+
+# ---------- in-process layer ----------
+
+def _local_get(telegram_id):
+    entry = _local.get(telegram_id)
+    if entry and entry[0] > time.monotonic():
+        return dict(entry[1])
+    return None
+
+
+def _local_put(telegram_id, balance):
+    with _local_lock:
+        if len(_local) >= BALANCE_LOCAL_MAX:
+            now = time.monotonic()
+            for key in [k for k, (expires, _) in _local.items() if expires <= now] or list(_local)[:len(_local) // 2]:
+                _local.pop(key, None)
+        _local[telegram_id] = (time.monotonic() + BALANCE_LOCAL_TTL, dict(balance))
+
+
+def _local_drop(telegram_id):
+    _local.pop(telegram_id, None)
+
+
+def _listen():
+    """Drop local entries that another process wrote to."""
+    while True:
+        try:
+            pubsub = _client_sync().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATE_CHANNEL)
+            for message in pubsub.listen():
+                _local_drop(int(message["data"]))
+        except Exception as e:
+            # Entries still expire after BALANCE_LOCAL_TTL while we reconnect
+            print(f"[WARN] Balance invalidation listener: {e}")
+            _local.clear()
+            time.sleep(1)
+
+
+def _ensure_subscriber():
+    """Start the listener thread once per process (again after a fork)."""
+    global _subscriber_pid
+    if _subscriber_pid != os.getpid():
+        _subscriber_pid = os.getpid()
+        _local.clear()
+        threading.Thread(target=_listen, name="balance-invalidation", daemon=True).start()
+
+
+def _balance(row):
+    return {"free_tokens": int(row["free_tokens"]), "vip_tokens": int(row["vip_tokens"])}
+
+
+# ---------- sync API (Celery workers, core/db.py) ----------
+
+def get(telegram_id):
+    """Cached {"free_tokens", "vip_tokens"} for a user, or None on a miss."""
+    _ensure_subscriber()
+    balance = _local_get(telegram_id)
+    if balance is not None:
+        return balance
+    try:
+        balance = _decode(_client_sync().get(_key(telegram_id)))
+    except redis.RedisError as e:
+        print(f"[WARN] Balance cache read failed: {e}")
+        return None
+    if balance is not None:
+        _local_put(telegram_id, balance)
+    return balance
+
+
+def put(telegram_id, row, written=False):
+    """
+    Cache a balance. written=False is a read-through fill (never overwrites);
+    written=True means the balance just changed, so every cached copy is dropped instead.
+    """
+    if written:
+        invalidate(telegram_id)
+        return
+    balance = _balance(row)
+    try:
+        filled = _client_sync().set(_key(telegram_id), _encode(balance), ex=BALANCE_REDIS_TTL, nx=True)
+    except redis.RedisError as e:
+        print(f"[WARN] Balance cache write failed: {e}")
+        return
+    if filled:
+        _local_put(telegram_id, balance)
+
+
+def invalidate(*telegram_ids):
+    for telegram_id in telegram_ids:
+        _local_drop(telegram_id)
+    try:
+        pipe = _client_sync().pipeline()
+        for telegram_id in telegram_ids:
+            pipe.delete(_key(telegram_id))
+            pipe.publish(INVALIDATE_CHANNEL, telegram_id)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"[WARN] Balance cache invalidation failed: {e}")
+
+
+# ---------- async API (bot, FastAPI, core/db_async.py) ----------
+
+async def aget(telegram_id):
+    _ensure_subscriber()
+    balance = _local_get(telegram_id)
+    if balance is not None:
+        return balance
+    try:
+        balance = _decode(await _client_async().get(_key(telegram_id)))
+    except redis.RedisError as e:
+        print(f"[WARN] Balance cache read failed: {e}")
+        return None
+    if balance is not None:
+        _local_put(telegram_id, balance)
+    return balance
+
+
+async def aput(telegram_id, row, written=False):
+    if written:
+        await ainvalidate(telegram_id)
+        return
+    balance = _balance(row)
+    try:
+        filled = await _client_async().set(_key(telegram_id), _encode(balance), ex=BALANCE_REDIS_TTL, nx=True)
+    except redis.RedisError as e:
+        print(f"[WARN] Balance cache write failed: {e}")
+        return
+    if filled:
+        _local_put(telegram_id, balance)
+
+
+async def ainvalidate(*telegram_ids):
+    for telegram_id in telegram_ids:
+        _local_drop(telegram_id)
+    try:
+        pipe = _client_async().pipeline()
+        for telegram_id in telegram_ids:
+            pipe.delete(_key(telegram_id))
+            pipe.publish(INVALIDATE_CHANNEL, telegram_id)
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"[WARN] Balance cache invalidation failed: {e}")
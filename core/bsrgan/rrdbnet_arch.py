@@ -54,6 +54,24 @@ class ResidualDenseBlock_5C(nn.Module):
         x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
         return x5 * 0.2 + x
 
+    def forward_fused(self, buf):
+        """
+        Inference-only forward over a contiguous (1, nf + 4*gc, H, W) workspace whose
+        first nf channels hold the input. Each activation is written straight into its
+        channel slice. For one NCHW sample every prefix buf[:, :end] is a single dense
+        block, so the convs read the dense concatenations without a copy. The result
+        replaces the input channels in place. Same math as forward().
+        """
+        nf = self.conv1.in_channels
+        gc = self.conv1.out_channels
+        convs = (self.conv1, self.conv2, self.conv3, self.conv4)
+        for i, conv in enumerate(convs):
+            end = nf + i * gc
+            torch.ops.aten.leaky_relu.out(conv(buf[:, :end]), 0.2, out=buf[:, end:end + gc])
+        x5 = self.conv5(buf)
+        buf[:, :nf].add_(x5, alpha=0.2)
+        return buf
+
 
 class RRDB(nn.Module):
     '''Residual in Residual Dense Block'''
@@ -70,12 +88,26 @@ class RRDB(nn.Module):
         out = self.RDB3(out)
         return out * 0.2 + x
 
+    def forward_fused(self, buf, skip):
+        """In-place counterpart of forward() on a ResidualDenseBlock_5C workspace; `skip` holds the input."""
+        nf = self.RDB1.conv1.in_channels
+        skip.copy_(buf[:, :nf])
+        self.RDB1.forward_fused(buf)
+        self.RDB2.forward_fused(buf)
+        self.RDB3.forward_fused(buf)
+        buf[:, :nf].mul_(0.2).add_(skip)
+        return buf
+
 
 class RRDBNet(nn.Module):
-    def __init__(self, in_nc=3, out_nc=3, nf=64, nb=23, gc=32, sf=4):
+    def __init__(self, in_nc=3, out_nc=3, nf=64, nb=23, gc=32, sf=4, fused=True):
         super(RRDBNet, self).__init__()
         RRDB_block_f = functools.partial(RRDB, nf=nf, gc=gc)
         self.sf = sf
+        self.nf = nf
+        self.gc = gc
+        self.fused = fused  # Use the allocation-free trunk when running without autograd
+        self.channels_last = False
         print([in_nc, out_nc, nf, nb, gc, sf])
 
         self.conv_first = nn.Conv2d(in_nc, nf, 3, 1, 1, bias=True)
@@ -90,9 +122,41 @@ class RRDBNet(nn.Module):
 
         self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
 
+    def run_trunk(self, fea):
+        """
+        RRDB_trunk over one preallocated workspace and skip buffer; needs no_grad since it
+        writes in place. Samples go through one at a time: only for a single NCHW sample
+        is every channel prefix of the workspace dense, which is what spares the copies.
+        """
+        n, _, h, w = fea.shape
+        buf = torch.empty((1, self.nf + 4 * self.gc, h, w), dtype=fea.dtype, device=fea.device)
+        skip = torch.empty((1, self.nf, h, w), dtype=fea.dtype, device=fea.device)
+        out = torch.empty((n, self.nf, h, w), dtype=fea.dtype, device=fea.device)
+        for i in range(n):
+            buf[:, :self.nf].copy_(fea[i:i + 1])
+            for block in self.RRDB_trunk:
+                block.forward_fused(buf, skip)
+            out[i:i + 1].copy_(buf[:, :self.nf])
+        return out
+
+    def use_channels_last(self):
+        """
+        Run activations as NHWC, which oneDNN convs prefer on CPU. Weights keep their
+        layout so memory-mapped parameters stay shared between processes; reordering
+        a 3x3 kernel per call is cheap next to the activations. Channel prefixes are
+        never dense in NHWC, so this uses the torch.cat trunk instead of run_trunk.
+        """
+        self.channels_last = True
+        return self
+
     def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         fea = self.conv_first(x)
-        trunk = self.trunk_conv(self.RRDB_trunk(fea))
+        if self.fused and not self.channels_last and not self.training and not torch.is_grad_enabled():
+            trunk = self.trunk_conv(self.run_trunk(fea))
+        else:
+            trunk = self.trunk_conv(self.RRDB_trunk(fea))
         fea = fea + trunk
 
         fea = self.lrelu(self.upconv1(F.interpolate(fea, scale_factor=2, mode='nearest')))
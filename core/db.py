@@ -1,7 +1,14 @@
 import os
+import threading
+from contextlib import contextmanager
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from core import queries
+from core import balance_cache
+from core.metrics import span
 
 load_dotenv()  # Load from .env file
 
@@ -10,6 +17,12 @@ DB_USER = os.getenv("DB_USER")
 DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
 
 def get_conn():
     return psycopg2.connect(
@@ -20,108 +33,102 @@ def get_conn():
         port=DB_PORT
     )
 
+def get_pool():
+    """Per-process connection pool; recreated after fork so prefork children never share sockets."""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    dbname=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD,
+                    host=DB_HOST,
+                    port=DB_PORT
+                )
+                _pool_pid = os.getpid()
+    return _pool
+
+@contextmanager
+def pooled_conn():
+    """Borrow a pooled connection; commits on success, rolls back on error."""
+    pool = get_pool()
+    with span("db"):
+        conn = pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            pool.putconn(conn, close=conn.closed != 0)
+
 async def register_user(telegram_id, referrer_id=None, bot_instance=None):
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
-    if cur.fetchone() is None:
-        if referrer_id:
-            # Check if referrer exists
-            cur.execute("SELECT * FROM users WHERE telegram_id = %s", (referrer_id,))
-            if cur.fetchone():
-                # Insert new user with 2 free gens
-                cur.execute("""
-                    INSERT INTO users (telegram_id, referrer_id, free_tokens)
-                    VALUES (%s, %s, 2)
-                """, (telegram_id, referrer_id))
-
-                # Reward the referrer
-                cur.execute("""
-                    UPDATE users SET free_tokens = free_tokens + 1
-                    WHERE telegram_id = %s
-                """, (referrer_id,))
-                
-                if bot_instance:
-                    try:
-                        await bot_instance.send_message(
-                            chat_id=referrer_id,
-                            text="🎉 Someone used your referral link! You've earned 1 free token."
-                        )
-                    except Exception as e:
-                        print(f"[WARN] Couldn't notify referrer {referrer_id}: {e}")
-            else:
-                # Referrer not found, just insert normal user
-                cur.execute("INSERT INTO users (telegram_id, free_tokens) VALUES (%s, 2)", (telegram_id,))
-        else:
-            # No referrer, insert new user with 2 free gens
-            cur.execute("INSERT INTO users (telegram_id, free_tokens) VALUES (%s, 2)", (telegram_id,))
-        conn.commit()
-
-    cur.close()
-    conn.close()
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(queries.REGISTER_USER, {"telegram_id": telegram_id, "referrer_id": referrer_id})
+        rewarded_referrer = cur.fetchone()[0]
+    if rewarded_referrer:
+        balance_cache.invalidate(rewarded_referrer)
+
+    # Notify outside the transaction so the connection isn't held across network I/O
+    if rewarded_referrer and bot_instance:
+        try:
+            await bot_instance.send_message(
+                chat_id=rewarded_referrer,
+                text="🎉 Someone used your referral link! You've earned 1 free token."
+            )
+        except Exception as e:
+            print(f"[WARN] Couldn't notify referrer {rewarded_referrer}: {e}")
 
 def get_user_generations(telegram_id):
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=DictCursor)
-    cur.execute("SELECT free_tokens, vip_tokens FROM users WHERE telegram_id = %s", (telegram_id,))
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
+    cached = balance_cache.get(telegram_id)
+    if cached is not None:
+        return cached
+
+    with pooled_conn() as conn, conn.cursor(cursor_factory=DictCursor) as cur:
+        cur.execute(queries.GET_USER_GENERATIONS, {"telegram_id": telegram_id})
+        result = cur.fetchone()
+    if result:
+        balance_cache.put(telegram_id, result)
     return result
 
 def decrement_generation(telegram_id):
-    conn = get_conn()
-    cur = conn.cursor()
-
-    # Fetch current balances first
-    cur.execute("SELECT vip_tokens, free_tokens FROM users WHERE telegram_id = %s", (telegram_id,))
-    result = cur.fetchone()
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(queries.DECREMENT_GENERATION, {"telegram_id": telegram_id})
+        result = cur.fetchone()
     if not result:
-        conn.close()
-        return None  # or raise error
-
-    vip, free = result
-
-    if vip > 0:
-        cur.execute("""
-            UPDATE users
-            SET vip_tokens = vip_tokens - 1
-            WHERE telegram_id = %s
-        """, (telegram_id,))
-        usage = "vip"
-    elif free > 0:
-        cur.execute("""
-            UPDATE users
-            SET free_tokens = free_tokens - 1
-            WHERE telegram_id = %s
-        """, (telegram_id,))
-        usage = "free"
-    else:
-        usage = None  # Should never happen, because checked earlier
-
-    conn.commit()
-    cur.close()
-    conn.close()
+        return None  # No such user; should never happen, because checked earlier
+
+    usage, free, vip = result
+    balance_cache.put(telegram_id, {"free_tokens": free, "vip_tokens": vip}, written=True)
     print(f"✅ Decremented {usage} generation for telegram_id={telegram_id}")
     return usage
 
+def charge_generations(telegram_id, count):
+    """Charge an album's tokens atomically. Returns {"vip": n, "free": n} spent, or None if no such user."""
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(queries.CHARGE_GENERATIONS, {"telegram_id": telegram_id, "count": count})
+        result = cur.fetchone()
+    if not result:
+        return None
+
+    vip_used, free_used, free, vip = result
+    balance_cache.put(telegram_id, {"free_tokens": free, "vip_tokens": vip}, written=True)
+    print(f"✅ Charged {vip_used} vip + {free_used} free generation(s) for telegram_id={telegram_id}")
+    return {"vip": vip_used, "free": free_used}
+
 def increment_vip_tokens(telegram_id: int, amount: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE users SET vip_tokens = vip_tokens + %s
-        WHERE telegram_id = %s
-    """, (amount, telegram_id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(queries.INCREMENT_VIP_TOKENS, {"telegram_id": telegram_id, "amount": amount})
+        result = cur.fetchone()
+    if result:
+        free, vip = result
+        balance_cache.put(telegram_id, {"free_tokens": free, "vip_tokens": vip}, written=True)
 
 def get_referral_count(telegram_id: int) -> int:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users WHERE referrer_id = %s", (telegram_id,))
-    count = cur.fetchone()[0]
-    cur.close()
-    conn.close()
-    return count
\ No newline at end of file
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(queries.GET_REFERRAL_COUNT, {"telegram_id": telegram_id})
+        result = cur.fetchone()
+    return result[0] if result else 0
@@ -0,0 +1,108 @@
+# core/db_async.py
+# Async, pooled counterpart of core/db.py for the bot and FastAPI (event-loop code).
+# Celery workers keep using the sync functions in core/db.py.
+import asyncio
+from dotenv import load_dotenv
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from core import queries
+from core import balance_cache
+from core.db import DB_NAME, DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_POOL_MIN, DB_POOL_MAX
+
+load_dotenv()
+
+_pool = None
+_pool_lock = asyncio.Lock()
+
+def _conninfo():
+    parts = {
+        "dbname": DB_NAME,
+        "user": DB_USER,
+        "password": DB_PASSWORD,
+        "host": DB_HOST,
+        "port": DB_PORT,
+    }
+    # make_conninfo quotes and escapes values (passwords with spaces, quotes or backslashes)
+    return make_conninfo(**{key: value for key, value in parts.items() if value})
+
+async def open_pool():
+    """Open the pool up front (bot post_init / FastAPI startup) instead of on the first query."""
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            pool = AsyncConnectionPool(_conninfo(), min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, open=False)
+            await pool.open()
+            _pool = pool
+    return _pool
+
+async def close_pool():
+    global _pool
+    async with _pool_lock:
+        if _pool is not None:
+            await _pool.close()
+            _pool = None
+
+async def get_pool():
+    return _pool or await open_pool()
+
+async def register_user(telegram_id, referrer_id=None, bot_instance=None):
+    pool = await get_pool()
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await cur.execute(queries.REGISTER_USER, {"telegram_id": telegram_id, "referrer_id": referrer_id})
+        rewarded_referrer = (await cur.fetchone())[0]
+    if rewarded_referrer:
+        await balance_cache.ainvalidate(rewarded_referrer)
+
+    # Notify outside the transaction so the connection isn't held across network I/O
+    if rewarded_referrer and bot_instance:
+        try:
+            await bot_instance.send_message(
+                chat_id=rewarded_referrer,
+                text="🎉 Someone used your referral link! You've earned 1 free token."
+            )
+        except Exception as e:
+            print(f"[WARN] Couldn't notify referrer {rewarded_referrer}: {e}")
+
+async def get_user_generations(telegram_id):
+    cached = await balance_cache.aget(telegram_id)
+    if cached is not None:
+        return cached
+
+    pool = await get_pool()
+    async with pool.connection() as conn, conn.cursor(row_factory=dict_row) as cur:
+        await cur.execute(queries.GET_USER_GENERATIONS, {"telegram_id": telegram_id})
+        result = await cur.fetchone()
+    if result:
+        await balance_cache.aput(telegram_id, result)
+    return result
+
+async def decrement_generation(telegram_id):
+    pool = await get_pool()
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await cur.execute(queries.DECREMENT_GENERATION, {"telegram_id": telegram_id})
+        result = await cur.fetchone()
+    if not result:
+        return None  # No such user; should never happen, because checked earlier
+
+    usage, free, vip = result
+    await balance_cache.aput(telegram_id, {"free_tokens": free, "vip_tokens": vip}, written=True)
+    print(f"✅ Decremented {usage} generation for telegram_id={telegram_id}")
+    return usage
+
+async def increment_vip_tokens(telegram_id: int, amount: int):
+    pool = await get_pool()
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await cur.execute(queries.INCREMENT_VIP_TOKENS, {"telegram_id": telegram_id, "amount": amount})
+        result = await cur.fetchone()
+    if result:
+        free, vip = result
+        await balance_cache.aput(telegram_id, {"free_tokens": free, "vip_tokens": vip}, written=True)
+
+async def get_referral_count(telegram_id: int) -> int:
+    pool = await get_pool()
+    async with pool.connection() as conn, conn.cursor() as cur:
+        await cur.execute(queries.GET_REFERRAL_COUNT, {"telegram_id": telegram_id})
+        result = await cur.fetchone()
+    return result[0] if result else 0
@@ -0,0 +1,97 @@
+# core/engine.py
+import hashlib
+import os
+
+import torch
+
+ENGINE_CACHE_DIR = os.getenv("ENGINE_CACHE_DIR", os.path.join("core", "bsrgan", "compiled"))
+ENGINE_TOLERANCE = float(os.getenv("ENGINE_TOLERANCE", "1e-3"))  # Max abs diff vs eager on export
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_shapes(spec):
+    """'4x512x512,1x128x128' -> [(4, 3, 512, 512), (1, 3, 128, 128)]"""
+    shapes = []
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        n, h, w = (int(v) for v in item.split("x"))
+        shapes.append((n, 3, h, w))
+    return shapes
+
+
+class TorchScriptEngine:
+    """
+    Runs the model through TorchScript modules traced and frozen per input shape.
+    Compiled modules are cached on disk under a key of weights hash + shape +
+    precision, so only the first worker to see a shape pays for the export.
+    """
+
+    def __init__(self, model, weights_hash, precision, device, cache_dir=ENGINE_CACHE_DIR):
+        self.model = model
+        self.weights_hash = weights_hash
+        self.precision = precision
+        self.device = device
+        self.cache_dir = cache_dir
+        self.modules = {}
+        self.failed = set()  # Shapes that could not be exported; they run eagerly
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def artifact_path(self, shape):
+        key = "_".join([
+            self.weights_hash[:16],
+            "x".join(str(d) for d in shape),
+            self.precision,
+            self.device.type,
+            torch.__version__.replace("+", "-"),
+        ])
+        return os.path.join(self.cache_dir, f"rrdbnet_{key}.pt")
+
+    def __call__(self, batch):
+        shape = tuple(batch.shape)
+        module = self.modules.get(shape)
+        if module is None and shape not in self.failed:
+            module = self.load(shape)
+        if module is None:
+            return self.model(batch)
+        return module(batch)
+
+    def load(self, shape):
+        """Load the compiled module for `shape` from disk, exporting it first if needed."""
+        path = self.artifact_path(shape)
+        try:
+            if os.path.exists(path):
+                module = torch.jit.load(path, map_location=self.device)
+            else:
+                module = self.export(shape, path)
+        except Exception as e:
+            print(f"[WARN] TorchScript export failed for {shape}, using eager: {e}")
+            self.failed.add(shape)
+            return None
+
+        self.modules[shape] = module
+        return module
+
+    def export(self, shape, path):
+        example = torch.rand(shape, device=self.device)
+        with torch.no_grad():
+            traced = torch.jit.trace(self.model, example)
+            module = torch.jit.freeze(traced.eval())
+            expected = self.model(example)
+            actual = module(example)
+
+        diff = (expected - actual).abs().max().item()
+        if diff > ENGINE_TOLERANCE:
+            raise RuntimeError(f"output mismatch vs eager: max abs diff {diff:.2e} > {ENGINE_TOLERANCE:.0e}")
+
+        # Write atomically so concurrent workers never load a half-written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.jit.save(module, tmp_path)
+        os.replace(tmp_path, path)
+        print(f"[⚙ ENGINE] Exported {path} (max abs diff {diff:.2e})")
+        return module
@@ -0,0 +1,282 @@
+# core/inference_server.py
+# Long-running inference service that batches tiles from many concurrent jobs.
+#
+# A Celery worker only runs one job at a time, and a small photo is just one or two tiles,
+# so most forward passes run far below the batch size the model could take. This server
+# owns the model, and workers send it tiles over a local socket:
+#   python -m core.inference_server                  # listens on INFERENCE_SERVER_ADDRESS
+#   INFERENCE_SERVER_ADDRESS=/tmp/upscaler.sock celery -A services.celery_app worker -Q vip,free -c 8
+# Both sides need the same INFERENCE_SERVER_AUTHKEY. Connections exchange pickles, so the
+# server only listens on a Unix socket or a loopback TCP address.
+# Requests for the same model tier whose tiles fall in the same shape bucket are packed into one batch. A batch
+# runs when it is full or when its oldest request has waited INFERENCE_MAX_WAIT_MS.
+import ipaddress
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from core.metrics import observe_tiles, start_exporter
+
+INFERENCE_SERVER_ADDRESS = os.getenv("INFERENCE_SERVER_ADDRESS", "")  # "/path/to.sock" or "loopback-host:port"
+INFERENCE_SERVER_AUTHKEY = os.getenv("INFERENCE_SERVER_AUTHKEY", "").encode()  # Required, shared secret
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "15"))
+SHAPE_BUCKET = int(os.getenv("INFERENCE_SHAPE_BUCKET", "64"))  # Tiles are padded up to a multiple of this to share batches
+
+
+def parse_address(address):
+    """"host:port" becomes a TCP address, anything else is a Unix socket path."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host or "127.0.0.1", int(port))
+    return address
+
+
+def _authkey():
+    if not INFERENCE_SERVER_AUTHKEY:
+        raise ValueError("❌ INFERENCE_SERVER_AUTHKEY not set. Use a long random value shared by server and workers.")
+    return INFERENCE_SERVER_AUTHKEY
+
+
+def _is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _bucket(tier, shape):
+    _, _, h, w = shape
+    return (tier, -(-h // SHAPE_BUCKET) * SHAPE_BUCKET, -(-w // SHAPE_BUCKET) * SHAPE_BUCKET)
+
+
+# ---------- client (Celery workers, via core.upscale_fn.process_tiles) ----------
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+_next_id = 0
+
+
+def _connect():
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        # A connection inherited across fork would interleave with the parent's
+        _client = Client(parse_address(INFERENCE_SERVER_ADDRESS), authkey=_authkey())
+        _client_pid = os.getpid()
+    return _client
+
+
+def _reset():
+    global _client
+    if _client is not None:
+        try:
+            _client.close()
+        except OSError:
+            pass
+    _client = None
+
+
+def remote_infer(batch, tier):
+    """Send an NCHW float batch in [0, 1] to the server's `tier` model; returns the upscaled batch as float32 on CPU."""
+    global _next_id
+    # The inputs are decoded 8-bit images, so uint8 is lossless and 4x smaller on the wire
+    tiles = (batch * 255).round().to(torch.uint8).cpu().numpy()
+    with _client_lock:
+        _next_id += 1
+        request_id = _next_id
+        for attempt in range(2):
+            try:
+                conn = _connect()
+                conn.send((request_id, tier, tiles))
+                reply_id, result = conn.recv()
+                break
+            except (OSError, EOFError) as e:
+                _reset()
+                if attempt:
+                    raise ConnectionError(f"❌ Inference server at {INFERENCE_SERVER_ADDRESS} unavailable: {e}")
+    if reply_id != request_id or isinstance(result, str):
+        raise RuntimeError(f"❌ Inference server failed: {result if isinstance(result, str) else 'reply out of order'}")
+    return torch.from_numpy(result.astype(np.float32))
+
+
+# ---------- server ----------
+
+class _Request:
+    __slots__ = ("conn", "send_lock", "request_id", "tier", "tiles", "arrived")
+
+    def __init__(self, conn, send_lock, request_id, tier, tiles):
+        self.conn = conn
+        self.send_lock = send_lock
+        self.request_id = request_id
+        self.tier = tier
+        self.tiles = tiles
+        self.arrived = time.monotonic()
+
+    def reply(self, result):
+        try:
+            with self.send_lock:
+                self.conn.send((self.request_id, result))
+        except OSError as e:
+            print(f"[WARN] Couldn't reply to inference client: {e}")
+
+
+def _check_request(tier, tiles):
+    """Why a request can't be batched, or None if it can."""
+    from core.models import MODEL_TIERS
+
+    if tier not in MODEL_TIERS:
+        return f"unknown model tier {tier!r}"
+    if not isinstance(tiles, np.ndarray) or tiles.ndim != 4 or tiles.shape[1] != 3 or tiles.dtype != np.uint8:
+        return "tiles must be a uint8 NCHW array with 3 channels"
+    return None
+
+
+def _serve_connection(conn, inbox):
+    """Reader thread per client: queue every valid request it sends until it disconnects."""
+    send_lock = threading.Lock()
+    try:
+        while True:
+            request_id, tier, tiles = conn.recv()
+            request = _Request(conn, send_lock, request_id, tier, tiles)
+            # Rejected here, so a bad request can't reach (and stop) the batcher thread
+            error = _check_request(tier, tiles)
+            if error:
+                request.reply(error)
+            else:
+                inbox.put(request)
+    except (EOFError, OSError, ValueError, TypeError) as e:
+        if not isinstance(e, EOFError):
+            print(f"[WARN] Dropping inference client: {e}")
+    finally:
+        conn.close()
+
+
+def _pad_to(tiles, size):
+    """Pad an NCHW tensor at the bottom/right up to (h, w), like TilePlan.pad does."""
+    _, _, h, w = tiles.shape
+    pad_h, pad_w = size[0] - h, size[1] - w
+    if not pad_h and not pad_w:
+        return tiles
+    mode = "reflect" if pad_h < h and pad_w < w else "replicate"
+    return F.pad(tiles, (0, pad_w, 0, pad_h), mode=mode)
+
+
+def _run_batch(requests, tier, size):
+    from core import upscale_fn
+
+    start = time.perf_counter()
+    try:
+        resident = upscale_fn.load_model(tier=tier)
+        if resident.scale != upscale_fn.scale_for(tier):
+            raise RuntimeError(f"model tier {tier!r} is not available on the inference server")
+        batch = torch.cat([_pad_to(torch.from_numpy(r.tiles).to(upscale_fn.device).float() / 255, size)
+                           for r in requests], dim=0)
+        output = upscale_fn.process_tile(batch, resident)
+        observe_tiles(len(batch), time.perf_counter() - start)
+        scale = resident.scale
+        offset = 0
+        for r in requests:
+            n, _, h, w = r.tiles.shape
+            # float16 keeps the error well under one 8-bit level and halves the reply size
+            r.reply(output[offset:offset + n, :, :h * scale, :w * scale].half().cpu().numpy())
+            offset += n
+    except Exception as e:
+        print(f"[❌ ERROR] Inference batch failed: {e}")
+        for r in requests:
+            r.reply(str(e))
+
+
+def _batcher(inbox, max_wait):
+    """Group requests by model tier and shape bucket; run a bucket when it is full or its oldest request is due."""
+    from core.upscale_fn import get_batch_size, scale_for
+
+    pending = {}  # bucket -> [requests], oldest first
+    batches = tiles_run = 0
+    while True:
+        if pending:
+            due = min(reqs[0].arrived for reqs in pending.values()) + max_wait
+            timeout = max(0.0, due - time.monotonic())
+        else:
+            timeout = None
+        try:
+            request = inbox.get(timeout=timeout)
+            pending.setdefault(_bucket(request.tier, request.tiles.shape), []).append(request)
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        for key in list(pending):
+            reqs = pending[key]
+            tier, size = key[0], key[1:]
+            try:
+                limit = get_batch_size(*size, scale_for(tier))
+            except Exception as e:
+                # Answer this bucket's clients and keep serving the others
+                print(f"[❌ ERROR] Can't batch tier {tier!r}: {e}")
+                for r in pending.pop(key):
+                    r.reply(str(e))
+                continue
+            queued = sum(len(r.tiles) for r in reqs)
+            if queued < limit and now - reqs[0].arrived < max_wait:
+                continue
+
+            # Take requests in arrival order up to the batch limit (at least one)
+            taken, count = [], 0
+            while reqs and (not taken or count + len(reqs[0].tiles) <= limit):
+                count += len(reqs[0].tiles)
+                taken.append(reqs.pop(0))
+            if not reqs:
+                del pending[key]
+            _run_batch(taken, tier, size)
+
+            batches += 1
+            tiles_run += count
+            if batches % 100 == 0:
+                print(f"[📦 BATCHER] {batches} batches, {tiles_run / batches:.1f} tiles/batch on average")
+
+
+def serve(address=INFERENCE_SERVER_ADDRESS, max_wait_ms=INFERENCE_MAX_WAIT_MS):
+    from core import upscale_fn
+
+    if not address:
+        raise ValueError("❌ Set INFERENCE_SERVER_ADDRESS to a socket path or host:port")
+    authkey = _authkey()
+    address = parse_address(address)
+    if isinstance(address, tuple) and not _is_loopback(address[0]):
+        # Clients send pickles, so anyone who can connect with the key can run code here
+        raise ValueError(f"❌ Refusing to listen on non-loopback host {address[0]!r}; use a Unix socket or 127.0.0.1")
+
+    # This process owns the model; process_tiles() must not route back to ourselves
+    upscale_fn.INFERENCE_SERVER_ADDRESS = ""
+    upscale_fn.warm_up()
+    start_exporter()
+
+    if isinstance(address, str) and os.path.exists(address):
+        os.remove(address)  # Stale socket from a previous run
+    inbox = queue.Queue()
+    threading.Thread(target=_batcher, args=(inbox, max_wait_ms / 1000), name="batcher", daemon=True).start()
+
+    with Listener(address, authkey=authkey) as listener:
+        print(f"[🚀 INFERENCE SERVER] Listening on {address}, max wait {max_wait_ms:.0f}ms")
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                # Failed handshakes (wrong authkey, port scans) must not stop the server
+                print(f"[WARN] Rejected inference client: {e}")
+                continue
+            threading.Thread(target=_serve_connection, args=(conn, inbox), daemon=True).start()
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,94 @@
+# core/ingest.py
+# Admission checks for uploaded images, run by the API before anything is queued.
+#
+# The upload is probed from its header only (format and dimensions, no pixel decode),
+# hashed in chunks, and copied to the blob store in chunks. Inputs a worker would
+# reject are refused here. Inputs that are only too large get shrunk here, with JPEG
+# draft decoding. Either way they never take a Celery slot.
+import hashlib
+import io
+import os
+import shutil
+
+from PIL import Image
+
+from core.upscale_fn import MAX_INPUT_DIM
+
+ALLOWED_FORMATS = ("JPEG", "PNG")
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+MAX_UPLOAD_DIM = int(os.getenv("MAX_UPLOAD_DIM", "12000"))  # Larger than this is refused; above MAX_INPUT_DIM is shrunk
+CHUNK_SIZE = 1024 * 1024
+
+
+class ImageRejected(ValueError):
+    """The upload can't be processed; `status` is the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def probe(fileobj):
+    """
+    Validate an upload from its header and hash it, reading in chunks.
+    Returns {"format", "width", "height", "bytes", "sha256", "downsize"}.
+    """
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    if size == 0:
+        raise ImageRejected("❌ Empty upload.")
+    if size > MAX_UPLOAD_BYTES:
+        raise ImageRejected(f"❌ File too large: {size / 2**20:.1f} MB > {MAX_UPLOAD_BYTES / 2**20:.0f} MB.", status=413)
+
+    # Image.open only parses the header; pixels are decoded on first access
+    try:
+        with Image.open(fileobj) as image:
+            fmt, (w, h) = image.format, image.size
+    except Image.DecompressionBombError:
+        raise ImageRejected("❌ Image has too many pixels.", status=413)
+    except Exception:
+        raise ImageRejected("❌ Not a readable image. Only JPEG and PNG are supported.")
+    if fmt not in ALLOWED_FORMATS:
+        raise ImageRejected(f"❌ Unsupported image format {fmt}. Only JPEG and PNG are supported.")
+    if w > MAX_UPLOAD_DIM or h > MAX_UPLOAD_DIM:
+        raise ImageRejected(f"❌ Input too large: {w}x{h} > {MAX_UPLOAD_DIM}px limit.", status=413)
+
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+
+    return {
+        "format": fmt,
+        "width": w,
+        "height": h,
+        "bytes": size,
+        "sha256": digest.hexdigest(),
+        "downsize": w > MAX_INPUT_DIM or h > MAX_INPUT_DIM,
+    }
+
+
+def store_input(fileobj, info, store, key):
+    """Copy a probed upload to the blob store in chunks, shrinking it to MAX_INPUT_DIM first if needed."""
+    fileobj.seek(0)
+    if not info["downsize"]:
+        with store.open_write(key) as dst:
+            shutil.copyfileobj(fileobj, dst, CHUNK_SIZE)
+        return
+
+    w, h = info["width"], info["height"]
+    factor = MAX_INPUT_DIM / max(w, h)
+    target = (max(1, int(w * factor)), max(1, int(h * factor)))
+    with Image.open(fileobj) as image:
+        if image.format == "JPEG":
+            image.draft("RGB", target)  # Decode at 1/2..1/8 scale straight from the DCT
+        image = image.convert("RGB").resize(target, Image.LANCZOS)
+
+    buf = io.BytesIO()
+    image.save(buf, format="JPEG", quality=95)
+    buf.seek(0)
+    with store.open_write(key) as dst:
+        shutil.copyfileobj(buf, dst, CHUNK_SIZE)
+    print(f"[📐 INGEST] Shrunk {w}x{h} upload to {target[0]}x{target[1]} before queueing")
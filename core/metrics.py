@@ -0,0 +1,103 @@
+# core/metrics.py
+# Job tracing and Prometheus metrics shared by the bot, the API, the scheduler and the workers.
+#
+# Every upload gets a job id in the bot. It travels to the API as a form field, becomes the
+# Celery task id and the pipeline's job["job_id"], and tags every span printed along the way:
+#   [⏱ SPAN] job=3f2a… decode 41.2 ms
+# Spans also feed the upscaler_stage_seconds histogram, and the gaps between pipeline
+# stages feed upscaler_queue_wait_seconds. Comparing the two shows whether slow jobs
+# were waiting in a queue or were slow to compute.
+#
+# The API serves GET /metrics. Other processes export on METRICS_PORT when it is set.
+# Celery prefork workers need PROMETHEUS_MULTIPROC_DIR (an empty directory per host)
+# so the parent's exporter can see the children's samples.
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, start_http_server
+from prometheus_client import multiprocess
+
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the exporter in this process
+
+# Tiles take milliseconds, whole jobs take minutes under load
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+STAGE_SECONDS = Histogram(
+    "upscaler_stage_seconds", "Time spent in each step of a job", ["stage"], buckets=BUCKETS
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "upscaler_queue_wait_seconds", "Time a job waited before a stage started", ["stage"], buckets=BUCKETS
+)
+TILE_SECONDS = Histogram(
+    "upscaler_tile_seconds", "Model time per tile (batch time divided by tiles in the batch)", buckets=BUCKETS
+)
+TILES = Counter("upscaler_tiles", "Tiles run through the model")
+JOBS = Counter("upscaler_jobs", "Jobs by final outcome", ["outcome"])
+
+_job_id = contextvars.ContextVar("job_id", default=None)
+
+
+def current_job():
+    return _job_id.get()
+
+
+@contextmanager
+def job_context(job_id):
+    """Tag every span inside the block with `job_id`."""
+    token = _job_id.set(job_id)
+    try:
+        yield
+    finally:
+        _job_id.reset(token)
+
+
+@contextmanager
+def span(stage, log=True):
+    """Time the block, record it under `stage` and print it with the current job id."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.labels(stage).observe(elapsed)
+        if log:
+            print(f"[⏱ SPAN] job={current_job() or '-'} {stage} {elapsed * 1000:.1f} ms")
+
+
+def observe_queue_wait(stage, since):
+    """Record how long a job sat queued before `stage`, given the wall-clock time it was handed off."""
+    if since:
+        wait = max(0.0, time.time() - since)
+        QUEUE_WAIT_SECONDS.labels(stage).observe(wait)
+        print(f"[⏱ QUEUE] job={current_job() or '-'} {stage} waited {wait * 1000:.1f} ms")
+
+
+def observe_tiles(count, seconds):
+    TILES.inc(count)
+    for _ in range(count):
+        TILE_SECONDS.observe(seconds / count)
+
+
+def registry():
+    """Registry to expose: merged across processes in multiprocess mode, else this process only."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        merged = CollectorRegistry()
+        multiprocess.MultiProcessCollector(merged)
+        return merged
+    return REGISTRY
+
+
+def start_exporter(port=METRICS_PORT):
+    """Serve /metrics over HTTP from this process, if a port is configured."""
+    if not port:
+        return
+    start_http_server(port, registry=registry())
+    print(f"[📈 METRICS] Exporting on :{port}/metrics")
+
+
+def mark_process_dead(pid):
+    """Drop a finished child's live gauges in multiprocess mode (histograms are kept)."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,210 @@
+# core/models.py
+# Registry of upscaling model tiers, kept resident per process under an LRU memory budget.
+#
+#   full   BSRGAN x4, 23 RRDB blocks (the original model, used for VIP users)
+#   light  few-block x4 RRDBNet, several times cheaper per tile (free users, small images)
+#   x2     BSRGAN x2, 4x fewer output pixels to compute and encode
+#
+# Every tier is an RRDBNet, so tiling, precision and the TorchScript backend work the same way.
+# A tier whose checkpoint is missing on this host falls back to DEFAULT_TIER: resolve_tier
+# already returns DEFAULT_TIER for it, and the registry warns if asked for it anyway.
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from core.bsrgan.rrdbnet_arch import RRDBNet
+from core.engine import TorchScriptEngine, file_sha256, parse_shapes
+from core.weights import ensure_mmap_weights, load_mmap_state_dict, bind_state_dict
+from core.precision import PRECISIONS, prepare_model, load_calibration_tiles, compare_precision
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Inference precision: fp32, bf16 (CPU autocast) or int8 (static quantized convs, CPU only)
+INFERENCE_PRECISION = os.getenv("INFERENCE_PRECISION", "fp32")
+
+# Execution backend: eager PyTorch, or TorchScript modules cached on disk per tile shape
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+ENGINE_PRELOAD_SHAPES = os.getenv("ENGINE_PRELOAD_SHAPES", "")  # e.g. "4x512x512,1x128x128"
+
+# NHWC activations on CPU (see RRDBNet.use_channels_last). Off until benchmarks/rdb_bench.py
+# shows it beating the fused NCHW trunk on the target hardware.
+INFERENCE_CHANNELS_LAST = os.getenv("INFERENCE_CHANNELS_LAST", "0") == "1"
+
+MODEL_MEMORY_BUDGET_MB = int(os.getenv("MODEL_MEMORY_BUDGET_MB", "512"))  # Resident models per process
+
+DEFAULT_TIER = "full"
+VIP_MODEL_TIER = os.getenv("VIP_MODEL_TIER", DEFAULT_TIER)
+FREE_MODEL_TIER = os.getenv("FREE_MODEL_TIER", "light")
+SMALL_IMAGE_TIER = os.getenv("SMALL_IMAGE_TIER", "light")  # Used for free users' images up to SMALL_IMAGE_PIXELS
+SMALL_IMAGE_PIXELS = int(os.getenv("SMALL_IMAGE_PIXELS", str(256 * 256)))
+
+
+class ModelSpec:
+    def __init__(self, name, weights_path, nb=23, sf=4, nf=64, gc=32):
+        self.name = name
+        self.weights_path = weights_path
+        self.nb = nb
+        self.sf = sf
+        self.nf = nf
+        self.gc = gc
+
+    def build(self):
+        return RRDBNet(in_nc=3, out_nc=3, nf=self.nf, nb=self.nb, gc=self.gc, sf=self.sf)
+
+    def available(self):
+        return os.path.exists(self.weights_path) or os.path.exists(os.path.splitext(self.weights_path)[0] + ".mmap")
+
+
+MODEL_TIERS = {
+    "full": ModelSpec("full", os.path.join("core", "bsrgan", "BSRGAN.pth"), nb=23, sf=4),
+    "light": ModelSpec("light", os.getenv("LIGHT_WEIGHTS_PATH", os.path.join("core", "bsrgan", "BSRGAN_light.pth")),
+                       nb=int(os.getenv("LIGHT_MODEL_BLOCKS", "6")), sf=4),
+    "x2": ModelSpec("x2", os.getenv("X2_WEIGHTS_PATH", os.path.join("core", "bsrgan", "BSRGANx2.pth")), nb=23, sf=2),
+}
+
+
+def scale_for(tier):
+    return MODEL_TIERS[tier or DEFAULT_TIER].sf
+
+
+def resolve_tier(requested=None, is_vip=False, image_size=None):
+    """
+    Tier for a job: an explicit request wins, VIP users get VIP_MODEL_TIER, free
+    users get FREE_MODEL_TIER, or SMALL_IMAGE_TIER for images up to SMALL_IMAGE_PIXELS.
+    Returns the tier that will actually run, so cache keys and admission stats match it.
+    """
+    if requested:
+        if requested not in MODEL_TIERS:
+            raise ValueError(f"❌ Unknown model tier {requested!r}, expected one of {tuple(MODEL_TIERS)}")
+        tier = requested
+    elif is_vip:
+        tier = VIP_MODEL_TIER
+    elif SMALL_IMAGE_TIER and image_size and image_size[0] * image_size[1] <= SMALL_IMAGE_PIXELS:
+        tier = SMALL_IMAGE_TIER
+    else:
+        tier = FREE_MODEL_TIER
+    # Same fallback as ModelRegistry.get for tiers without weights (e.g. light isn't shipped)
+    spec = MODEL_TIERS.get(tier)
+    if spec is None or not spec.available():
+        return DEFAULT_TIER
+    return tier
+
+
+class ResidentModel:
+    """A loaded tier: the module to run, its precision and optional TorchScript engine."""
+
+    def __init__(self, spec, model, precision, engine=None):
+        self.spec = spec
+        self.model = model
+        self.precision = precision
+        self.engine = engine
+        self.scale = spec.sf
+        self.nbytes = _state_bytes(model)
+
+    @property
+    def runner(self):
+        return self.engine or self.model
+
+
+def _state_bytes(model):
+    """Bytes held by a model's weights (quantized convs keep theirs in packed tuples)."""
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, (tuple, list)) else (value,)):
+            if isinstance(tensor, torch.Tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+
+def load_spec(spec, requested_precision=None):
+    """Build, load and prepare one tier's model on `device`."""
+    weights_path = spec.weights_path
+    model = spec.build()
+    if device.type == "cpu":
+        # Parameters point straight at the mapped file, so prefork children share its pages
+        weights_path = ensure_mmap_weights(spec.weights_path)
+        bind_state_dict(model, load_mmap_state_dict(weights_path))
+    else:
+        model.load_state_dict(torch.load(weights_path, map_location=device), strict=True)
+    model.eval()
+    model = model.to(device)
+    if INFERENCE_CHANNELS_LAST and device.type == "cpu":
+        model.use_channels_last()
+
+    requested_precision = requested_precision or INFERENCE_PRECISION
+    if requested_precision not in PRECISIONS:
+        raise ValueError(f"❌ Unknown INFERENCE_PRECISION {requested_precision!r}, expected one of {PRECISIONS}")
+    if requested_precision != "fp32" and device.type != "cpu":
+        print(f"[WARN] {requested_precision} inference is CPU-only, using fp32 on {device}")
+        requested_precision = "fp32"
+
+    if requested_precision != "fp32":
+        reference = model
+        model = prepare_model(reference, requested_precision)
+        report = compare_precision(reference, model, requested_precision, load_calibration_tiles(count=4, size=128))
+        print(f"[🎚 PRECISION] {spec.name} {requested_precision}: PSNR {report['psnr_db']:.2f} dB vs fp32, "
+              f"{report['seconds']:.2f}s vs {report['fp32_seconds']:.2f}s")
+
+    engine = None
+    if INFERENCE_BACKEND == "torchscript":
+        if requested_precision == "bf16":
+            print("[WARN] TorchScript backend does not support bf16 autocast, using eager")
+        else:
+            engine = TorchScriptEngine(model, file_sha256(weights_path), requested_precision, device)
+            for shape in parse_shapes(ENGINE_PRELOAD_SHAPES):
+                engine.load(shape)
+    elif INFERENCE_BACKEND != "eager":
+        print(f"[WARN] Unknown INFERENCE_BACKEND {INFERENCE_BACKEND!r}, using eager")
+
+    return ResidentModel(spec, model, requested_precision, engine)
+
+
+class ModelRegistry:
+    """
+    Loaded tiers in least-recently-used order. Loading a tier that would go over
+    the memory budget evicts the least recently used others first; the tier in
+    use is always kept, even if it alone exceeds the budget.
+    """
+
+    def __init__(self, budget_mb=MODEL_MEMORY_BUDGET_MB):
+        self.budget = budget_mb * 1024 * 1024
+        self.resident = OrderedDict()
+        self.lock = threading.RLock()
+        self.missing = set()  # Tiers already reported as unavailable
+
+    def get(self, tier=None, requested_precision=None):
+        tier = tier or DEFAULT_TIER
+        with self.lock:
+            if tier in self.resident:
+                self.resident.move_to_end(tier)
+                return self.resident[tier]
+
+            spec = MODEL_TIERS.get(tier)
+            if spec is None or not spec.available():
+                if tier == DEFAULT_TIER:
+                    raise FileNotFoundError(f"❌ Weights for {DEFAULT_TIER!r} not found at {MODEL_TIERS[DEFAULT_TIER].weights_path}")
+                if tier not in self.missing:
+                    self.missing.add(tier)
+                    print(f"[WARN] Model tier {tier!r} has no weights on this host, using {DEFAULT_TIER!r}")
+                return self.get(DEFAULT_TIER, requested_precision)
+
+            return self.install(tier, load_spec(spec, requested_precision))
+
+    def install(self, tier, resident):
+        """Make `resident` the loaded model for `tier`, evicting others over the budget."""
+        with self.lock:
+            self.resident.pop(tier, None)
+            used = sum(m.nbytes for m in self.resident.values())
+            while self.resident and used + resident.nbytes > self.budget:
+                evicted, old = self.resident.popitem(last=False)
+                used -= old.nbytes
+                print(f"[♻ MODEL] Evicted {evicted!r} ({old.nbytes / 2**20:.0f} MB) to fit {tier!r}")
+            self.resident[tier] = resident
+            print(f"[✅ MODEL] {tier!r} resident: nb={resident.spec.nb} x{resident.scale} "
+                  f"{resident.precision}, {resident.nbytes / 2**20:.0f} MB")
+            return resident
+
+
+registry = ModelRegistry()
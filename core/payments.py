@@ -2,7 +2,7 @@
 import os
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, Update
 from telegram.ext import ContextTypes
-from core.db import increment_vip_tokens
+from core.db_async import increment_vip_tokens
 
 # Show purchase options
 async def purchase(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -69,7 +69,7 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
         generations = 1
 
     telegram_id = update.effective_user.id
-    increment_vip_tokens(telegram_id, generations)
+    await increment_vip_tokens(telegram_id, generations)
 
     await update.message.reply_text(
         f"✅ Payment successful! You've been credited with {generations} generation(s)."
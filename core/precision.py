@@ -0,0 +1,138 @@
+# core/precision.py
+import contextlib
+import copy
+import glob
+import math
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+INT8_CALIBRATION_DIR = os.getenv("INT8_CALIBRATION_DIR")  # Folder of sample photos for int8 calibration
+CALIBRATION_TILE = 64
+CALIBRATION_TILES = 16
+
+
+def autocast_context(precision):
+    """Context manager applied around every forward pass for the given precision."""
+    if precision == "bf16":
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def quantize_int8(model, calibration_tiles):
+    """
+    Static int8 quantization of every Conv2d via FX graph mode.
+    Dynamic quantization only covers Linear/LSTM layers, so the convs
+    need observers calibrated on representative tiles.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    model = copy.deepcopy(model).cpu().eval()
+    if hasattr(model, "fused"):
+        model.fused = False  # FX can't trace the in-place RRDBNet trunk
+    qconfig_mapping = get_default_qconfig_mapping("fbgemm")
+    prepared = prepare_fx(model, qconfig_mapping, example_inputs=(calibration_tiles[0],))
+    with torch.no_grad():
+        for tile in calibration_tiles:
+            prepared(tile)
+    return convert_fx(prepared)
+
+
+def load_calibration_tiles(count=CALIBRATION_TILES, size=CALIBRATION_TILE):
+    """Random crops from INT8_CALIBRATION_DIR, or smooth synthetic tiles if it is not set."""
+    from PIL import Image
+    from torchvision.transforms.functional import to_tensor
+
+    tiles = []
+    paths = sorted(glob.glob(os.path.join(INT8_CALIBRATION_DIR, "*"))) if INT8_CALIBRATION_DIR else []
+    generator = torch.Generator().manual_seed(0)
+    for path in paths:
+        try:
+            image = to_tensor(Image.open(path).convert("RGB")).unsqueeze(0)
+        except Exception as e:
+            print(f"[WARN] Skipping calibration image {path}: {e}")
+            continue
+        _, _, h, w = image.shape
+        if h < size or w < size:
+            continue
+        y = int(torch.randint(0, h - size + 1, (1,), generator=generator))
+        x = int(torch.randint(0, w - size + 1, (1,), generator=generator))
+        tiles.append(image[:, :, y:y+size, x:x+size])
+        if len(tiles) >= count:
+            return tiles
+
+    if not tiles:
+        print("[WARN] INT8_CALIBRATION_DIR not set or empty, calibrating on synthetic tiles")
+    while len(tiles) < count:
+        noise = torch.rand((1, 3, size // 8, size // 8), generator=generator)
+        tiles.append(F.interpolate(noise, size=(size, size), mode="bilinear", align_corners=False))
+    return tiles
+
+
+def prepare_model(model, precision, calibration_tiles=None):
+    """Return the model to run for `precision` (a quantized copy for int8)."""
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    if precision == "int8":
+        return quantize_int8(model, calibration_tiles or load_calibration_tiles())
+    return model
+
+
+def psnr(reference, output):
+    """PSNR in dB between two tensors in [0, 1]."""
+    mse = torch.mean((reference.float() - output.float()) ** 2).item()
+    if mse == 0:
+        return float("inf")
+    return 10 * math.log10(1.0 / mse)
+
+
+def compare_precision(reference_model, model, precision, tiles):
+    """PSNR of `model` under `precision` against fp32 `reference_model`, plus both timings."""
+    scores = []
+    ref_time = 0.0
+    run_time = 0.0
+    with torch.no_grad():
+        for tile in tiles:
+            start = time.perf_counter()
+            reference = reference_model(tile).clamp(0, 1)
+            ref_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            with autocast_context(precision):
+                output = model(tile).float().clamp(0, 1)
+            run_time += time.perf_counter() - start
+            scores.append(psnr(reference, output))
+
+    return {
+        "precision": precision,
+        "psnr_db": sum(scores) / len(scores),
+        "fp32_seconds": ref_time,
+        "seconds": run_time,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from core.bsrgan.rrdbnet_arch import RRDBNet
+
+    parser = argparse.ArgumentParser(description="Compare reduced-precision RRDBNet against fp32")
+    parser.add_argument("--weights", default=os.path.join("core", "bsrgan", "BSRGAN.pth"))
+    parser.add_argument("--precision", choices=PRECISIONS, default="int8")
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    fp32_model = RRDBNet(in_nc=3, out_nc=3, nf=64, nb=23, sf=4)
+    fp32_model.load_state_dict(torch.load(args.weights, map_location="cpu"), strict=True)
+    fp32_model.eval()
+
+    tiles = load_calibration_tiles()
+    candidate = prepare_model(fp32_model, args.precision, tiles)
+    print(compare_precision(fp32_model, candidate, args.precision, load_calibration_tiles(count=4, size=128)))
@@ -0,0 +1,72 @@
+# core/queries.py
+# SQL shared by the sync (psycopg2) and async (psycopg 3) layers; both use %(name)s parameters.
+
+# Create the user if missing and, in the same statement, reward an existing referrer.
+# rewarded_referrer is the referrer's id when a reward was granted, else NULL.
+REGISTER_USER = """
+    WITH referrer AS (
+        SELECT telegram_id FROM users WHERE telegram_id = %(referrer_id)s
+    ), inserted AS (
+        INSERT INTO users (telegram_id, referrer_id, free_tokens)
+        VALUES (%(telegram_id)s, (SELECT telegram_id FROM referrer), 2)
+        ON CONFLICT (telegram_id) DO NOTHING
+        RETURNING referrer_id
+    ), rewarded AS (
+        UPDATE users
+        SET free_tokens = free_tokens + 1,
+            referral_count = referral_count + 1
+        WHERE telegram_id = (SELECT referrer_id FROM inserted)
+        RETURNING telegram_id
+    )
+    SELECT (SELECT telegram_id FROM rewarded) AS rewarded_referrer
+"""
+
+GET_USER_GENERATIONS = "SELECT free_tokens, vip_tokens FROM users WHERE telegram_id = %(telegram_id)s"
+
+# Spend one VIP token if any, otherwise one free token, atomically.
+# The locked "before" row tells which balance was charged; usage is NULL if neither was.
+DECREMENT_GENERATION = """
+    WITH before AS (
+        SELECT telegram_id, vip_tokens, free_tokens
+        FROM users WHERE telegram_id = %(telegram_id)s
+        FOR UPDATE
+    )
+    UPDATE users AS u
+    SET vip_tokens = u.vip_tokens - CASE WHEN b.vip_tokens > 0 THEN 1 ELSE 0 END,
+        free_tokens = u.free_tokens - CASE WHEN b.vip_tokens <= 0 AND b.free_tokens > 0 THEN 1 ELSE 0 END
+    FROM before AS b
+    WHERE u.telegram_id = b.telegram_id
+    RETURNING CASE WHEN b.vip_tokens > 0 THEN 'vip'
+                   WHEN b.free_tokens > 0 THEN 'free' END AS usage,
+              u.free_tokens, u.vip_tokens
+"""
+
+# Spend %(count)s tokens for an album in one statement: VIP tokens first, then free ones.
+# Charges only what the balances cover; returns how many of each were spent.
+CHARGE_GENERATIONS = """
+    WITH before AS (
+        SELECT telegram_id, free_tokens,
+               LEAST(GREATEST(vip_tokens, 0), %(count)s) AS vip_used
+        FROM users WHERE telegram_id = %(telegram_id)s
+        FOR UPDATE
+    ), charge AS (
+        SELECT telegram_id, vip_used,
+               LEAST(GREATEST(free_tokens, 0), %(count)s - vip_used) AS free_used
+        FROM before
+    )
+    UPDATE users AS u
+    SET vip_tokens = u.vip_tokens - c.vip_used,
+        free_tokens = u.free_tokens - c.free_used
+    FROM charge AS c
+    WHERE u.telegram_id = c.telegram_id
+    RETURNING c.vip_used, c.free_used, u.free_tokens, u.vip_tokens
+"""
+
+INCREMENT_VIP_TOKENS = """
+    UPDATE users SET vip_tokens = vip_tokens + %(amount)s
+    WHERE telegram_id = %(telegram_id)s
+    RETURNING free_tokens, vip_tokens
+"""
+
+# Maintained by REGISTER_USER (see migrations/001_referral_counter.sql)
+GET_REFERRAL_COUNT = "SELECT referral_count FROM users WHERE telegram_id = %(telegram_id)s"
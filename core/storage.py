@@ -0,0 +1,257 @@
+# core/storage.py
+import io
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BLOB_BACKEND = os.getenv("BLOB_BACKEND", "local")  # local | redis | s3
+BLOB_TTL = int(os.getenv("BLOB_TTL", "3600"))  # Seconds before an unclaimed blob is cleaned up
+BLOB_LOCAL_DIR = os.path.abspath(os.getenv("BLOB_LOCAL_DIR", "temp"))
+BLOB_REDIS_URL = os.getenv("BLOB_REDIS_URL") or os.getenv("REDIS_BROKER_URL") or "redis://localhost:6379/0"
+BLOB_S3_BUCKET = os.getenv("BLOB_S3_BUCKET", "upscaler")
+BLOB_S3_ENDPOINT = os.getenv("BLOB_S3_ENDPOINT")  # e.g. http://localhost:9000 for a local MinIO
+CHUNK_SIZE = 1024 * 1024
+
+
+class BlobStore:
+    """
+    Byte storage shared by the API and the workers, addressed by flat string keys.
+    Subclasses implement open_read/open_write/delete/exists/cleanup.
+    """
+
+    def put(self, key, data):
+        """Store bytes or copy a readable file object under `key`."""
+        with self.open_write(key) as dst:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                dst.write(data)
+            else:
+                shutil.copyfileobj(data, dst, CHUNK_SIZE)
+
+    def get(self, key):
+        with self.open_read(key) as src:
+            return src.read()
+
+    def iter_chunks(self, key, chunk_size=CHUNK_SIZE):
+        with self.open_read(key) as src:
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                yield chunk
+
+
+class LocalBlobStore(BlobStore):
+    """Files in one directory; only works when every process sees the same disk."""
+
+    def __init__(self, root=BLOB_LOCAL_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, os.path.basename(key))
+
+    def open_read(self, key):
+        return open(self.path(key), "rb")
+
+    @contextmanager
+    def open_write(self, key):
+        # Write to a temp name so readers never see a partial blob
+        path = self.path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                yield f
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def cleanup(self, max_age=BLOB_TTL):
+        cutoff = time.time() - max_age
+        removed = 0
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.isfile(path) and os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+class _RedisReader(io.RawIOBase):
+    """Streams a Redis string value with GETRANGE instead of loading it whole."""
+
+    def __init__(self, client, key):
+        self.client = client
+        self.key = key
+        self.offset = 0
+        self.size = client.strlen(key)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.offset >= self.size:
+            return 0
+        end = min(self.offset + len(buffer), self.size) - 1
+        chunk = self.client.getrange(self.key, self.offset, end)
+        buffer[:len(chunk)] = chunk
+        self.offset += len(chunk)
+        return len(chunk)
+
+
+class _RedisWriter(io.RawIOBase):
+    """Buffers writes and APPENDs them to a staging key in chunks, renamed into place on close."""
+
+    def __init__(self, client, key, ttl):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+        self.staging_key = f"{key}:partial:{os.getpid()}"
+        self.pending = bytearray()
+        client.delete(self.staging_key)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= CHUNK_SIZE:
+            self._flush_pending()
+        return len(data)
+
+    def _flush_pending(self):
+        if self.pending:
+            pipe = self.client.pipeline()
+            pipe.append(self.staging_key, bytes(self.pending))
+            pipe.expire(self.staging_key, self.ttl)
+            pipe.execute()
+            self.pending.clear()
+
+    def commit(self):
+        self._flush_pending()
+        if not self.client.exists(self.staging_key):
+            self.client.set(self.staging_key, b"")
+        pipe = self.client.pipeline()
+        pipe.rename(self.staging_key, self.key)
+        pipe.expire(self.key, self.ttl)
+        pipe.execute()
+
+    def abort(self):
+        self.client.delete(self.staging_key)
+
+
+class RedisBlobStore(BlobStore):
+    """Blobs as Redis strings with a TTL; cleanup is left to Redis expiry."""
+
+    def __init__(self, url=BLOB_REDIS_URL, ttl=BLOB_TTL):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _key(self, key):
+        return f"blob:{key}"
+
+    def open_read(self, key):
+        if not self.client.exists(self._key(key)):
+            raise FileNotFoundError(key)
+        return io.BufferedReader(_RedisReader(self.client, self._key(key)), CHUNK_SIZE)
+
+    @contextmanager
+    def open_write(self, key):
+        writer = _RedisWriter(self.client, self._key(key), self.ttl)
+        try:
+            yield writer
+            writer.commit()
+        except BaseException:
+            writer.abort()
+            raise
+
+    def exists(self, key):
+        return bool(self.client.exists(self._key(key)))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def cleanup(self, max_age=BLOB_TTL):
+        return 0
+
+
+class S3BlobStore(BlobStore):
+    """
+    Objects in an S3-compatible bucket. Point BLOB_S3_ENDPOINT at MinIO (or any
+    other stand-in) to run without AWS.
+    """
+
+    def __init__(self, bucket=BLOB_S3_BUCKET, endpoint_url=BLOB_S3_ENDPOINT):
+        import boto3
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        self.bucket = bucket
+
+    def open_read(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(key)
+
+    @contextmanager
+    def open_write(self, key):
+        # Spool locally (in memory up to CHUNK_SIZE * 8) and upload as a multipart stream
+        with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE * 8) as spool:
+            yield spool
+            spool.seek(0)
+            self.client.upload_fileobj(spool, self.bucket, key)
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except Exception:
+            return False
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def cleanup(self, max_age=BLOB_TTL):
+        cutoff = time.time() - max_age
+        removed = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket):
+            stale = [{"Key": obj["Key"]} for obj in page.get("Contents", [])
+                     if obj["LastModified"].timestamp() < cutoff]
+            if stale:
+                self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": stale})
+                removed += len(stale)
+        return removed
+
+
+BACKENDS = {
+    "local": LocalBlobStore,
+    "redis": RedisBlobStore,
+    "s3": S3BlobStore,
+}
+
+_store = None
+
+def get_blob_store():
+    """Process-wide store for the backend selected by BLOB_BACKEND."""
+    global _store
+    if _store is None:
+        if BLOB_BACKEND not in BACKENDS:
+            raise ValueError(f"❌ Unknown BLOB_BACKEND {BLOB_BACKEND!r}, expected one of {sorted(BACKENDS)}")
+        _store = BACKENDS[BLOB_BACKEND]()
+    return _store
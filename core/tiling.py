@@ -0,0 +1,97 @@
+# core/tiling.py
+import functools
+import math
+
+import torch
+import torch.nn.functional as F
+
+TILE_ALIGN = 16  # Tile sides are rounded up to a multiple of this so shapes repeat across images
+
+
+def _round_up(value, multiple):
+    return int(math.ceil(value / multiple) * multiple)
+
+
+def _axis_starts(length, tile, overlap):
+    """
+    Minimum number of equally sized windows covering [0, length),
+    spread evenly so the last one ends exactly on the border.
+    """
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    count = int(math.ceil((length - overlap) / stride))
+    step = (length - tile) / (count - 1)
+    return [int(round(i * step)) for i in range(count)]
+
+
+def _ramp(size, ramp, taper_start, taper_end):
+    """1D blending weights: linear ramp on tapered edges, flat elsewhere."""
+    weights = torch.ones(size)
+    ramp = min(ramp, size // 2)
+    if ramp <= 0:
+        return weights
+    edge = (torch.arange(ramp, dtype=torch.float32) + 0.5) / ramp
+    if taper_start:
+        weights[:ramp] = edge
+    if taper_end:
+        weights[-ramp:] = edge.flip(0)
+    return weights
+
+
+class TilePlan:
+    """
+    Uniform tile grid for one input size.
+    Every tile has the same (tile_h, tile_w) shape; inputs smaller than a tile
+    are reflect-padded by (pad_h, pad_w) and the padding is cropped after inference.
+    """
+
+    def __init__(self, height, width, tile_size=512, overlap=8, scale=4):
+        self.height = height
+        self.width = width
+        self.scale = scale
+        self.overlap = overlap
+
+        self.tile_h = min(tile_size, _round_up(height, TILE_ALIGN))
+        self.tile_w = min(tile_size, _round_up(width, TILE_ALIGN))
+        self.pad_h = max(0, self.tile_h - height)
+        self.pad_w = max(0, self.tile_w - width)
+
+        padded_h = height + self.pad_h
+        padded_w = width + self.pad_w
+        self.ys = _axis_starts(padded_h, self.tile_h, overlap)
+        self.xs = _axis_starts(padded_w, self.tile_w, overlap)
+        self.tiles = [(y, x) for y in self.ys for x in self.xs]
+        self._weights = {}
+
+    def __len__(self):
+        return len(self.tiles)
+
+    @property
+    def output_size(self):
+        """(height, width) of the padded model output."""
+        return (self.height + self.pad_h) * self.scale, (self.width + self.pad_w) * self.scale
+
+    def pad(self, img_tensor):
+        """Reflect-pad an NCHW tensor up to the plan's tile shape."""
+        if not self.pad_h and not self.pad_w:
+            return img_tensor
+        # Reflect needs the pad to be smaller than the side; fall back to replicate for tiny inputs
+        mode = "reflect" if self.pad_h < self.height and self.pad_w < self.width else "replicate"
+        return F.pad(img_tensor, (0, self.pad_w, 0, self.pad_h), mode=mode)
+
+    def weight(self, y, x):
+        """Feathered (1, tile_h*scale, tile_w*scale) blending weights for the tile at (y, x)."""
+        key = (y > 0, x > 0, y != self.ys[-1], x != self.xs[-1])
+        if key not in self._weights:
+            ramp = self.overlap * self.scale
+            wy = _ramp(self.tile_h * self.scale, ramp, key[0], key[2])
+            wx = _ramp(self.tile_w * self.scale, ramp, key[1], key[3])
+            self._weights[key] = (wy[:, None] * wx[None, :]).unsqueeze(0)
+        return self._weights[key]
+
+
+@functools.lru_cache(maxsize=64)
+def plan_tiles(height, width, tile_size=512, overlap=8, scale=4):
+    """Cached TilePlan for an input size, reused across images of the same shape."""
+    return TilePlan(height, width, tile_size, overlap, scale)
@@ -1,118 +1,240 @@
 import sys
 import os
+import math
+import time
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+import numpy as np
 import torch
 from PIL import Image
-from torchvision.transforms.functional import to_tensor, to_pil_image
+from torchvision.transforms.functional import to_tensor
 
-from core.bsrgan.rrdbnet_arch import RRDBNet
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = None
+from core.assembly import BandAssembler
+from core.metrics import span, observe_tiles
+from core.models import DEFAULT_TIER, device, registry, scale_for
+from core.precision import autocast_context
+from core.tiling import plan_tiles
 
 MAX_INPUT_DIM = 4096       # Reject anything above this
 SAFE_OUTPUT_DIM = 8192     # Downscale input if upscaled version would exceed this
 MAX_FINAL_DIM = 6000       # Final image must not exceed this in either width or height
 TELEGRAM_MAX_SUM = 10000   # Telegram: width + height must be ≤ 10000
 
-def load_model():
-    global model
-    if model is None:
-        weights_path = os.path.join("core", "bsrgan", "BSRGAN.pth")
-        model = RRDBNet(in_nc=3, out_nc=3, nf=64, nb=23, sf=4)
-        model.load_state_dict(torch.load(weights_path, map_location=device), strict=True)
-        model.eval()
-        model = model.to(device)
-
-def process_tile(tile_tensor):
-    """Run a single tile through the model."""
-    with torch.no_grad():
-        output = model(tile_tensor).clamp(0, 1)
+# Tile batching: 0 means derive the batch size from the memory budget
+TILE_BATCH_SIZE = int(os.getenv("TILE_BATCH_SIZE", "0"))
+TILE_MEMORY_BUDGET_MB = int(os.getenv("TILE_MEMORY_BUDGET_MB", "2048"))
+MAX_TILE_BATCH_SIZE = 16
+
+# Send tiles to a shared core.inference_server instead of running the model in this process
+INFERENCE_SERVER_ADDRESS = os.getenv("INFERENCE_SERVER_ADDRESS", "")
+
+WARMUP_TILE_SIZE = int(os.getenv("WARMUP_TILE_SIZE", "512"))  # 0 disables the warm-up pass
+PRELOAD_TIERS = [t for t in os.getenv("PRELOAD_TIERS", DEFAULT_TIER).split(",") if t]  # Tiers loaded at worker start
+
+def load_model(requested_precision: str = None, tier: str = None):
+    """Resident model for a tier (see core/models.py), loading it on first use."""
+    return registry.get(tier, requested_precision)
+
+def warm_up(tile_size: int = WARMUP_TILE_SIZE, tiers=None):
+    """Load the models and run one forward pass each so the first real job starts hot."""
+    if INFERENCE_SERVER_ADDRESS:
+        return  # The inference server owns the model
+    for tier in tiers or PRELOAD_TIERS:
+        resident = load_model(tier=tier)
+        if tile_size <= 0:
+            continue
+        plan = plan_tiles(tile_size, tile_size, tile_size, 8, resident.scale)
+        n = get_batch_size(plan.tile_h, plan.tile_w, resident.scale)
+        tiles = [torch.zeros((1, 3, plan.tile_h, plan.tile_w), device=device)] * n
+        process_tiles(tiles, resident)
+        print(f"[🔥 WARM-UP] {tier}: ran {n} tile(s) of {plan.tile_w}x{plan.tile_h}")
+
+def process_tile(tile_tensor, resident=None):
+    """Run a single tile (or a batch) through a resident model, the default tier if none is given."""
+    resident = resident or load_model()
+    with torch.no_grad(), autocast_context(resident.precision):
+        output = resident.runner(tile_tensor).float().clamp(0, 1)
+    return output
+
+def process_tiles(tiles, resident=None, tier=None):
+    """Run a list of same-shaped tiles through the model in one forward pass."""
+    batch = torch.cat(tiles, dim=0)
+    start = time.perf_counter()
+    if INFERENCE_SERVER_ADDRESS:
+        from core.inference_server import remote_infer
+        output = remote_infer(batch, tier or DEFAULT_TIER).to(device)
+    else:
+        output = process_tile(batch, resident)
+    observe_tiles(len(tiles), time.perf_counter() - start)
     return output
 
-def upscale_image(input_path: str, output_path: str, tile_size: int = 512, tile_overlap: int = 8):
+def estimate_tile_bytes(tile_h, tile_w, scale=4, nf=64, gc=32):
+    """
+    Rough peak activation memory of one tile in float32.
+    The dense block stack (nf + 4*gc channels) dominates at input resolution,
+    the nf-channel upsampling convs dominate at output resolution.
+    """
+    lr_pixels = tile_h * tile_w
+    hr_pixels = lr_pixels * scale * scale
+    lr_bytes = (nf + 4 * gc) * 2 * lr_pixels * 4
+    hr_bytes = nf * 3 * hr_pixels * 4
+    return lr_bytes + hr_bytes
+
+def get_batch_size(tile_h, tile_w, scale=4):
+    """Tiles per forward pass: TILE_BATCH_SIZE if set, else what fits the memory budget."""
+    if TILE_BATCH_SIZE > 0:
+        return TILE_BATCH_SIZE
+    budget = TILE_MEMORY_BUDGET_MB * 1024 * 1024
+    fits = budget // max(estimate_tile_bytes(tile_h, tile_w, scale), 1)
+    return int(max(1, min(MAX_TILE_BATCH_SIZE, fits)))
+
+def plan_geometry(w, h, scale):
+    """
+    Input size to run the model on, so its output already fits every output limit
+    (SAFE_OUTPUT_DIM, MAX_FINAL_DIM, TELEGRAM_MAX_SUM) and no computed pixel is resized away.
+    """
+    out_w, out_h = w * scale, h * scale
+    factor = min(1.0,
+                 SAFE_OUTPUT_DIM / max(out_w, out_h),
+                 MAX_FINAL_DIM / max(out_w, out_h),
+                 TELEGRAM_MAX_SUM / (out_w + out_h))
+    if factor >= 1.0:
+        return w, h
+    return max(1, int(w * factor)), max(1, int(h * factor))
+
+def fit_output(image, scale):
+    """Downscale a decoded input to the size plan_geometry() gives for `scale`."""
+    target = plan_geometry(*image.size, scale)
+    if target != image.size:
+        image = image.resize(target, Image.LANCZOS)
+    return image
+
+def decode_image(input_path, scale: int = 4):
+    """
+    Open an input (path or file object) as RGB at the size the model should see.
+    Large JPEGs are decoded in draft mode (DCT scaling), so pixels that would be
+    thrown away are never decoded at full resolution.
+    """
+    image = Image.open(input_path)
+    w, h = image.size
+    print(f"[📥 INPUT] Original size: {w}x{h}")
+
+    # Reject too large input
+    if w > MAX_INPUT_DIM or h > MAX_INPUT_DIM:
+        raise ValueError(f"❌ Input too large: {w}x{h} > {MAX_INPUT_DIM}px limit.")
+
+    # Work out the deliverable size first, then decode only as much as it needs
+    target = plan_geometry(w, h, scale)
+    if target != (w, h):
+        if image.format == "JPEG":
+            image.draft("RGB", target)  # Largest 1/2, 1/4 or 1/8 scale still >= target
+        print(f"[📐 GEOMETRY] Model input {target[0]}x{target[1]} (decoded at {image.size[0]}x{image.size[1]}) "
+              f"for a {target[0] * scale}x{target[1] * scale} output")
+
+    image = image.convert("RGB")
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+    return image
+
+def run_model(image, tile_size: int = 512, tile_overlap: int = 8, batch_size: int = None, tier: str = None):
+    """Upscale a decoded RGB image with the tier's model, tile by tile."""
+    resident = None
+    if INFERENCE_SERVER_ADDRESS:
+        scale = scale_for(tier)
+    else:
+        resident = load_model(tier=tier)
+        scale = resident.scale
+        # The tier may have fallen back to a model with a larger scale than decode assumed
+        image = fit_output(image, scale)
+
+    img_tensor = to_tensor(image).unsqueeze(0).to(device)
+
+    _, _, h, w = img_tensor.shape
+
+    # Plan a uniform tile grid and pad the input up to it
+    plan = plan_tiles(h, w, tile_size, tile_overlap, scale)
+    img_tensor = plan.pad(img_tensor)
+    th, tw = plan.tile_h, plan.tile_w
+    print(f"[🧩 TILES] {len(plan)} tiles of {tw}x{th}")
+
+    # Band accumulator tall enough for one batch worth of tile rows
+    n = batch_size or get_batch_size(th, tw, scale)
+    rows_per_band = max(1, math.ceil(n / len(plan.xs)))
+    bands = [plan.ys[i:i + rows_per_band] for i in range(0, len(plan.ys), rows_per_band)]
+    band_h = max(band[-1] - band[0] + th for band in bands) * scale
+    _, out_w = plan.output_size
+    assembler = BandAssembler(band_h, out_w, h * scale, w * scale, device)
+
+    for band in bands:
+        # Rows above this band are no longer touched by any tile
+        assembler.advance(band[0] * scale)
+        coords = [(y, x) for y in band for x in plan.xs]
+
+        # Run the band's tiles through the model in fixed-size batches
+        for i in range(0, len(coords), n):
+            chunk = coords[i:i + n]
+            tiles = [img_tensor[:, :, y:y+th, x:x+tw] for y, x in chunk]
+            sr_tiles = process_tiles(tiles, resident, tier)
+
+            for (y, x), sr_tile in zip(chunk, sr_tiles):
+                assembler.add(sr_tile, plan.weight(y, x).to(device), y * scale, x * scale)
+
+    # Flush the last band (padding rows/columns are cropped here)
+    return assembler.finish()
+
+def finalize_image(sr_image):
+    """Shrink the model output to fit the final size and Telegram limits."""
+    final_w, final_h = sr_image.size
+    print(f"[📤 OUTPUT BEFORE LIMIT] {final_w}x{final_h}")
+
+    # Step 1: Apply MAX_FINAL_DIM limit
+    if final_w > MAX_FINAL_DIM or final_h > MAX_FINAL_DIM:
+        resize_factor = MAX_FINAL_DIM / max(final_w, final_h)
+        new_w = int(final_w * resize_factor)
+        new_h = int(final_h * resize_factor)
+        sr_image = sr_image.resize((new_w, new_h), Image.LANCZOS)
+        final_w, final_h = sr_image.size
+        print(f"[⚠ FINAL RESIZE] Resized to: {new_w}x{new_h} due to MAX_FINAL_DIM")
+
+    # Step 2: Apply Telegram's width+height limit
+    if (final_w + final_h) > TELEGRAM_MAX_SUM:
+        resize_factor = TELEGRAM_MAX_SUM / (final_w + final_h)
+        new_w = int(final_w * resize_factor)
+        new_h = int(final_h * resize_factor)
+        sr_image = sr_image.resize((new_w, new_h), Image.LANCZOS)
+        final_w, final_h = sr_image.size
+        print(f"[⚠ TELEGRAM RESIZE] Resized to: {new_w}x{new_h} to meet width+height ≤ {TELEGRAM_MAX_SUM}")
+
+    # Final log
+    print(f"[✅ FINAL OUTPUT] {final_w}x{final_h}")
+    return sr_image
+
+def encode_image(sr_image, output_path):
+    sr_image.save(output_path, format="JPEG")
+
+def save_raw(image, output_file):
+    """Uncompressed hand-off format between pipeline stages (uint8 HxWx3 .npy)."""
+    np.save(output_file, np.asarray(image), allow_pickle=False)
+
+def load_raw(input_file):
+    return Image.fromarray(np.load(input_file, allow_pickle=False))
+
+def upscale_image(input_path, output_path, tile_size: int = 512, tile_overlap: int = 8, batch_size: int = None,
+                  tier: str = None):
     """
     Upscales an image using tiling to prevent OOM, 
     while keeping output within Telegram and size limits.
+    Input and output may be paths or file objects (e.g. blob store streams);
+    an input given as a path is deleted afterwards.
     """
     try:
-        load_model()
-
-        # Load image
-        image = Image.open(input_path).convert("RGB")
-        w, h = image.size
-        print(f"[📥 INPUT] Original size: {w}x{h}")
-
-        # Reject too large input
-        if w > MAX_INPUT_DIM or h > MAX_INPUT_DIM:
-            raise ValueError(f"❌ Input too large: {w}x{h} > {MAX_INPUT_DIM}px limit.")
-
-        # Downscale if output would exceed safe limit
-        if w * 4 > SAFE_OUTPUT_DIM or h * 4 > SAFE_OUTPUT_DIM:
-            scale_factor = SAFE_OUTPUT_DIM / max(w, h)
-            new_w = int(w * scale_factor)
-            new_h = int(h * scale_factor)
-            image = image.resize((new_w, new_h), Image.LANCZOS)
-            w, h = image.size
-
-        img_tensor = to_tensor(image).unsqueeze(0).to(device)
-
-        _, _, h, w = img_tensor.shape
-        scale = 4  # Model scale factor
-
-        # Prepare output tensor
-        output_tensor = torch.zeros(
-            (1, 3, h * scale, w * scale), device=device
-        )
-        weight_map = torch.zeros_like(output_tensor)
-
-        # Iterate over tiles
-        for y in range(0, h, tile_size - tile_overlap):
-            for x in range(0, w, tile_size - tile_overlap):
-                tile = img_tensor[:, :, y:y+tile_size, x:x+tile_size]
-                sr_tile = process_tile(tile)
-
-                out_y = y * scale
-                out_x = x * scale
-                oh, ow = sr_tile.shape[2], sr_tile.shape[3]
-
-                output_tensor[:, :, out_y:out_y+oh, out_x:out_x+ow] += sr_tile
-                weight_map[:, :, out_y:out_y+oh, out_x:out_x+ow] += 1
-
-        # Normalize and clamp
-        output_tensor /= weight_map
-        output_tensor = output_tensor.clamp(0, 1)
-
-        # Convert to PIL
-        sr_image = to_pil_image(output_tensor.squeeze(0).cpu())
-        final_w, final_h = sr_image.size
-        print(f"[📤 OUTPUT BEFORE LIMIT] {final_w}x{final_h}")
-
-        # Step 1: Apply MAX_FINAL_DIM limit
-        if final_w > MAX_FINAL_DIM or final_h > MAX_FINAL_DIM:
-            resize_factor = MAX_FINAL_DIM / max(final_w, final_h)
-            new_w = int(final_w * resize_factor)
-            new_h = int(final_h * resize_factor)
-            sr_image = sr_image.resize((new_w, new_h), Image.LANCZOS)
-            final_w, final_h = sr_image.size
-            print(f"[⚠ FINAL RESIZE] Resized to: {new_w}x{new_h} due to MAX_FINAL_DIM")
-
-        # Step 2: Apply Telegram's width+height limit
-        if (final_w + final_h) > TELEGRAM_MAX_SUM:
-            resize_factor = TELEGRAM_MAX_SUM / (final_w + final_h)
-            new_w = int(final_w * resize_factor)
-            new_h = int(final_h * resize_factor)
-            sr_image = sr_image.resize((new_w, new_h), Image.LANCZOS)
-            final_w, final_h = sr_image.size
-            print(f"[⚠ TELEGRAM RESIZE] Resized to: {new_w}x{new_h} to meet width+height ≤ {TELEGRAM_MAX_SUM}")
-
-        # Final log
-        print(f"[✅ FINAL OUTPUT] {final_w}x{final_h}")
-
-        # Save output
-        sr_image.save(output_path, format="JPEG")
+        with span("decode"):
+            image = decode_image(input_path, scale_for(tier))
+        with span("infer"):
+            sr_image = run_model(image, tile_size, tile_overlap, batch_size, tier)
+        with span("encode"):
+            encode_image(finalize_image(sr_image), output_path)
 
     finally:
-        if os.path.exists(input_path):
+        if isinstance(input_path, str) and os.path.exists(input_path):
             os.remove(input_path)
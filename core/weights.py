@@ -0,0 +1,104 @@
+# core/weights.py
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+def mmap_path_for(weights_path):
+    return os.path.splitext(weights_path)[0] + ".mmap"
+
+
+def export_mmap_weights(state_dict, path):
+    """
+    Write a state_dict as one flat binary file plus a JSON index, so every
+    process can map the same file instead of holding its own copy.
+    """
+    index = {}
+    offset = 0
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    tmp_index = f"{path}.json.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        for name, tensor in state_dict.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            f.write(array.tobytes())
+            index[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+            offset += array.nbytes
+
+    with open(tmp_index, "w") as f:
+        json.dump(index, f)
+    # Data first, index last: a crash in between leaves a missing or stale index,
+    # which _index_matches rejects, so the next start simply exports again
+    os.replace(tmp_path, path)
+    os.replace(tmp_index, f"{path}.json")
+
+
+def _index_matches(path):
+    """True if the JSON index is readable and describes exactly the bytes in the data file."""
+    try:
+        with open(f"{path}.json") as f:
+            index = json.load(f)
+        end = max((entry["offset"] + int(np.prod(entry["shape"], dtype=np.int64)) * np.dtype(entry["dtype"]).itemsize
+                   for entry in index.values()), default=0)
+        return end == os.path.getsize(path)
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def ensure_mmap_weights(weights_path):
+    """Convert a .pth checkpoint to the memory-mappable format once; returns the mmap path."""
+    path = mmap_path_for(weights_path)
+    fresh = os.path.exists(path) and (not os.path.exists(weights_path)
+                                      or os.path.getmtime(path) >= os.path.getmtime(weights_path))
+    if fresh and _index_matches(path):
+        return path
+
+    state_dict = torch.load(weights_path, map_location="cpu")
+    export_mmap_weights(state_dict, path)
+    print(f"[📦 WEIGHTS] Wrote memory-mapped weights to {path}")
+    return path
+
+
+def load_mmap_state_dict(path):
+    """
+    Tensors backed directly by the mapped file. Copy-on-write mode keeps the
+    pages shared between processes as long as nobody writes to them.
+    """
+    with open(f"{path}.json") as f:
+        index = json.load(f)
+    data = np.memmap(path, dtype=np.uint8, mode="c")
+
+    state_dict = {}
+    for name, entry in index.items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        start = entry["offset"]
+        array = data[start:start + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        state_dict[name] = torch.from_numpy(array)
+    return state_dict
+
+
+def bind_state_dict(model, state_dict):
+    """
+    Like load_state_dict(strict=True), but makes the model's parameters and
+    buffers *be* the given tensors instead of copying into them.
+    """
+    expected = set(model.state_dict().keys())
+    missing = expected - set(state_dict)
+    unexpected = set(state_dict) - expected
+    if missing or unexpected:
+        raise RuntimeError(f"State dict mismatch: missing={sorted(missing)} unexpected={sorted(unexpected)}")
+
+    for name, tensor in state_dict.items():
+        module_name, _, leaf = name.rpartition(".")
+        module = model.get_submodule(module_name) if module_name else model
+        current = getattr(module, leaf)
+        if current.shape != tensor.shape:
+            raise RuntimeError(f"Shape mismatch for {name}: {tuple(tensor.shape)} vs {tuple(current.shape)}")
+        if leaf in module._parameters:
+            module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[leaf] = tensor
+    return model
@@ -0,0 +1,25 @@
+-- migrations/001_referral_counter.sql
+-- Apply with: psql "$DATABASE_URL" -f migrations/001_referral_counter.sql
+--
+-- Adds a maintained referral counter so /profile no longer runs COUNT(*) over users,
+-- an index for the remaining referrer lookups, and the unique key that
+-- INSERT ... ON CONFLICT (telegram_id) in core/queries.py relies on.
+
+BEGIN;
+
+ALTER TABLE users ADD COLUMN IF NOT EXISTS referral_count INTEGER NOT NULL DEFAULT 0;
+
+UPDATE users AS u
+SET referral_count = r.total
+FROM (
+    SELECT referrer_id, COUNT(*) AS total
+    FROM users
+    WHERE referrer_id IS NOT NULL
+    GROUP BY referrer_id
+) AS r
+WHERE u.telegram_id = r.referrer_id;
+
+CREATE INDEX IF NOT EXISTS users_referrer_id_idx ON users (referrer_id);
+CREATE UNIQUE INDEX IF NOT EXISTS users_telegram_id_key ON users (telegram_id);
+
+COMMIT;
@@ -0,0 +1,110 @@
+# services/admission.py
+# Admission control for new upscale jobs: estimate the wait from queue depth and
+# rolling service times, and shed free-tier load before the queues run away.
+#
+# Workers record how long inference took per tile and per job (record_inference).
+# At enqueue time the API adds up the jobs waiting ahead in the tier's lists: the
+# scheduler's pending list and the Celery broker queue. It divides that work by
+# the tier's share of the inference workers and adds the new job's own
+# tiles * seconds-per-tile. Free jobs are refused with a retry hint when the queue
+# or the ETA is past its limit. VIP jobs are always admitted, so their latency
+# stays flat while free traffic spikes.
+import os
+import statistics
+
+import redis
+
+from core.models import scale_for
+from core.tiling import plan_tiles
+from core.upscale_fn import plan_geometry
+from services import scheduler
+from services.redis_client import get_redis
+
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", str(scheduler.DISPATCH_CAPACITY)))  # Jobs in inference at once
+FREE_MAX_QUEUE = int(os.getenv("FREE_MAX_QUEUE", "500"))  # Free jobs waiting before new ones are shed
+FREE_MAX_ETA = float(os.getenv("FREE_MAX_ETA", "900"))  # Seconds; free jobs expected to wait longer are shed
+JOB_OVERHEAD_SECONDS = float(os.getenv("JOB_OVERHEAD_SECONDS", "2"))  # Decode, encode and delivery per job
+DEFAULT_TILE_SECONDS = float(os.getenv("DEFAULT_TILE_SECONDS", "1.5"))  # Until real samples exist
+SAMPLES = 200  # Rolling window per key
+
+TILE_SECONDS_KEY = "admission:tile_seconds:{}"  # Per model tier
+JOB_SECONDS_KEY = "admission:job_seconds:{}"  # Per inference queue
+
+_broker = None
+
+
+class Shed(Exception):
+    """A free job was refused; `retry_after` is the suggested wait in seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _broker_client():
+    """Celery's Redis broker keeps each queue as a list named after it."""
+    global _broker
+    if _broker is None:
+        _broker = redis.Redis.from_url(os.getenv("REDIS_BROKER_URL") or "redis://localhost:6379/0")
+    return _broker
+
+
+def estimate_tiles(width, height, model_tier=None, tile_size=512, overlap=8):
+    """Tiles run_model will process for an input, after the output geometry is planned."""
+    scale = scale_for(model_tier)
+    w, h = plan_geometry(width, height, scale)
+    return len(plan_tiles(h, w, tile_size, overlap, scale))
+
+
+def record_inference(queue, model_tier, tiles, seconds):
+    """Called by the inference stage after each job."""
+    pipe = get_redis().pipeline()
+    pipe.lpush(TILE_SECONDS_KEY.format(model_tier), seconds / max(tiles, 1))
+    pipe.ltrim(TILE_SECONDS_KEY.format(model_tier), 0, SAMPLES - 1)
+    pipe.lpush(JOB_SECONDS_KEY.format(queue), seconds)
+    pipe.ltrim(JOB_SECONDS_KEY.format(queue), 0, SAMPLES - 1)
+    pipe.execute()
+
+
+def _median(key, default):
+    samples = [float(v) for v in get_redis().lrange(key, 0, SAMPLES - 1)]
+    return statistics.median(samples) if samples else default
+
+
+def queue_depth(queue):
+    """Jobs waiting for inference in a tier: scheduler backlog plus the Celery queue."""
+    depth = scheduler.pending_count(queue)
+    try:
+        depth += _broker_client().llen(queue)
+    except redis.RedisError as e:
+        print(f"[WARN] Couldn't read broker queue {queue}: {e}")
+    return depth
+
+
+def estimate(queue, model_tier, tiles):
+    """Expected seconds until a new job's result is delivered, plus the queue depths used."""
+    depths = {tier: queue_depth(tier) for tier in scheduler.TIERS}
+
+    # Busy tiers split the workers by scheduler weight; an idle tier leaves its share to the others
+    busy = [tier for tier in scheduler.TIERS if depths[tier] or tier == queue]
+    share = scheduler.TIER_WEIGHTS[queue] / sum(scheduler.TIER_WEIGHTS[tier] for tier in busy)
+
+    default_job = DEFAULT_TILE_SECONDS * max(tiles, 1)
+    job_seconds = _median(JOB_SECONDS_KEY.format(queue), default_job)
+    tile_seconds = _median(TILE_SECONDS_KEY.format(model_tier), DEFAULT_TILE_SECONDS)
+
+    waiting = depths[queue] * job_seconds / max(INFERENCE_WORKERS * share, 1e-6)
+    own = tiles * tile_seconds + JOB_OVERHEAD_SECONDS
+    return {"eta_seconds": round(waiting + own, 1), "queue_depth": depths[queue], "depths": depths}
+
+
+def admit(queue, model_tier, tiles):
+    """Estimate for a new job, raising Shed if a free job should not be queued."""
+    result = estimate(queue, model_tier, tiles)
+    if queue == "free":
+        if result["queue_depth"] >= FREE_MAX_QUEUE or result["eta_seconds"] > FREE_MAX_ETA:
+            # Suggest coming back once roughly the excess has drained
+            retry_after = int(max(30, result["eta_seconds"] - FREE_MAX_ETA))
+            print(f"[🚦 SHED] free job refused: depth {result['queue_depth']}, ETA {result['eta_seconds']:.0f}s")
+            raise Shed("Free queue is full", retry_after)
+    return result
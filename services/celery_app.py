@@ -15,4 +15,15 @@ celery = Celery(
     backend=os.getenv("REDIS_RESULT_BACKEND")
 )
 
+# Periodic cleanup of unclaimed blobs (run `celery -A services.celery_app beat`)
+celery.conf.beat_schedule = {
+    "cleanup-blobs": {
+        "task": "services.tasks.cleanup_blobs_task",
+        "schedule": float(os.getenv("BLOB_CLEANUP_INTERVAL", "600")),
+        "options": {"queue": os.getenv("IO_QUEUE", "io")},
+    },
+}
+
 import services.tasks
+import services.pipeline
+import workers.upscale_worker
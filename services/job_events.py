@@ -0,0 +1,84 @@
+# services/job_events.py
+# Job progress over Redis pub/sub, so API clients wait on a push instead of polling Celery.
+#
+# Pipeline stages publish {"status": ...} events on job:{job_id}. A terminal event
+# ("done" or "failed") is also kept under job:status:{job_id} for BLOB_TTL, so a
+# client that subscribes after the job finished still sees the result.
+import asyncio
+import json
+from contextlib import aclosing
+
+from core.storage import BLOB_TTL
+from services.redis_client import get_redis, get_async_redis
+
+TERMINAL = ("done", "failed")
+
+
+def _channel(job_id):
+    return f"job:{job_id}"
+
+
+def _status_key(job_id):
+    return f"job:status:{job_id}"
+
+
+def publish(job_id, status, **fields):
+    """Announce a job's progress (sync; called from Celery workers)."""
+    event = json.dumps(dict(fields, status=status, job_id=job_id))
+    try:
+        pipe = get_redis().pipeline()
+        if status in TERMINAL:
+            pipe.set(_status_key(job_id), event, ex=BLOB_TTL)
+        pipe.publish(_channel(job_id), event)
+        pipe.execute()
+    except Exception as e:
+        # Telegram delivery doesn't depend on this; API waiters fall back to their timeout
+        print(f"[WARN] Couldn't publish {status} for job {job_id}: {e}")
+
+
+async def final_status(job_id):
+    raw = await get_async_redis().get(_status_key(job_id))
+    return json.loads(raw) if raw else None
+
+
+async def events(job_id, timeout, heartbeat=None):
+    """
+    Yield the job's events until a terminal one or until `timeout` seconds pass.
+    With `heartbeat`, yields None every `heartbeat` seconds of silence (for SSE keep-alives).
+    """
+    pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe(_channel(job_id))
+    try:
+        # Subscribed first, so a job finishing right now is either published to us or already stored
+        done = await final_status(job_id)
+        if done:
+            yield done
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            wait = deadline - loop.time()
+            if heartbeat:
+                wait = min(wait, heartbeat)
+            message = await pubsub.get_message(timeout=wait)
+            if message is None:
+                if heartbeat:
+                    yield None
+                continue
+            event = json.loads(message["data"])
+            yield event
+            if event["status"] in TERMINAL:
+                return
+    finally:
+        await pubsub.unsubscribe()
+        await pubsub.aclose()
+
+
+async def wait(job_id, timeout):
+    """The job's terminal event, or its latest progress event (or None) if `timeout` passes first."""
+    last = None
+    async with aclosing(events(job_id, timeout)) as stream:
+        async for last in stream:
+            pass
+    return last
@@ -0,0 +1,303 @@
+# services/pipeline.py
+# Staged upscale pipeline: decode -> infer -> encode -> deliver.
+#
+# Only infer_stage touches the model and runs on the vip/free queues (heavy workers).
+# The other stages run on IO_QUEUE, served by light workers started with PRELOAD_MODEL=0:
+#   celery -A services.celery_app worker -Q io -c 16
+#   celery -A services.celery_app worker -Q vip,free -c 2
+# Stages hand images to each other through the blob store, passing a job dict along the chain.
+# An album job (new_album_job) carries one item per image under "album"; each stage
+# handles all of them, and deliver_stage sends them back with one sendMediaGroup.
+import io
+import os
+import sys
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from celery import chain
+
+from services.celery_app import celery
+from core.db import decrement_generation, charge_generations
+from core.metrics import JOBS, job_context, span, observe_queue_wait
+from core.storage import get_blob_store
+from core.models import scale_for
+from core.upscale_fn import decode_image, run_model, finalize_image, encode_image, save_raw, load_raw
+from services import admission, job_events, result_cache, scheduler
+from services.tasks import (send_photo, send_media_group, usage_caption, album_caption, notify_failure,
+                           deliver_to_waiters)
+
+IO_QUEUE = os.getenv("IO_QUEUE", "io")
+
+
+def _readable(store, key):
+    """np.load needs a seekable file; remote stores are buffered in memory."""
+    src = store.open_read(key)
+    if hasattr(src, "seekable") and src.seekable():
+        return src
+    with src:
+        return io.BytesIO(src.read())
+
+
+def _items(job):
+    """The images a job works on: its album items, or the job itself."""
+    return job.get("album") or [job]
+
+
+def _item_id(item):
+    return item.get("item_id") or item["job_id"]
+
+
+def _intermediate_keys(job):
+    return [item.get(k) for item in _items(job) for k in ("input_key", "decoded_key", "upscaled_key")]
+
+
+def _release_slot(job):
+    """Give the scheduler back its inference slot once the job leaves inference."""
+    if job.get("scheduled") and not job.get("slot_released"):
+        scheduler.release_slot(job["job_id"])
+        job["slot_released"] = True
+
+
+def _release_user(job):
+    if job.get("scheduled"):
+        scheduler.release_user(job["chat_id"], job["job_id"])
+
+
+def _renew_leases(job):
+    """Still alive: keep the scheduler from reaping this job's slots."""
+    if not job.get("scheduled"):
+        return
+    try:
+        scheduler.renew(job["job_id"], job["chat_id"], slot=not job.get("slot_released"))
+    except Exception as e:
+        print(f"[WARN] Couldn't renew scheduler leases: {e}")
+
+
+@contextmanager
+def _lease_heartbeat(job):
+    """
+    Renew the job's leases now and every LEASE_RENEW_INTERVAL while a stage runs,
+    so a long inference (CPU full model, a 10-image album) isn't reaped mid-job.
+    The thread dies with the worker, so a killed job's leases still run out.
+    """
+    if not job.get("scheduled"):
+        yield
+        return
+    stop = threading.Event()
+
+    def beat():
+        _renew_leases(job)
+        while not stop.wait(scheduler.LEASE_RENEW_INTERVAL):
+            _renew_leases(job)
+
+    thread = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _record_service_time(job, size, seconds):
+    """Feed the admission controller's rolling per-tile and per-job times."""
+    try:
+        tiles = admission.estimate_tiles(*size, job.get("tier"))
+        admission.record_inference(job.get("queue", "free"), job.get("tier") or "full", tiles, seconds)
+    except Exception as e:
+        print(f"[WARN] Couldn't record service time: {e}")
+
+
+def _fail(job, error):
+    """Tell the user, release coalesced waiters and drop every blob the job created."""
+    print(f"[❌ ERROR] Job {job.get('job_id')}: {error}")
+    JOBS.labels("failed").inc()
+    _release_slot(job)
+    _release_user(job)
+    notify_failure(job["chat_id"])
+    job_events.publish(job["job_id"], "failed", error=str(error))
+    if job.get("content_hash") and not job.get("cached_file_id"):
+        deliver_to_waiters(job["content_hash"], None)
+    store = get_blob_store()
+    for key in _intermediate_keys(job) + [item.get("output_key") for item in _items(job)]:
+        if key:
+            store.delete(key)
+
+
+def _run(job, name, stage):
+    """Run one stage under the job's id, timing both its queue wait and its work."""
+    with job_context(job.get("trace_id") or job["job_id"]), _lease_heartbeat(job):
+        # Inference waits are split by tier queue, since that is where vip and free differ
+        wait_label = f"infer_{job['queue']}" if name == "infer" and job.get("queue") else name
+        observe_queue_wait(wait_label, job.get("handoff_at"))
+        try:
+            with span(name):
+                result = stage(job)
+        except Exception as e:
+            _fail(job, e)
+            raise
+        if isinstance(result, dict):
+            result["handoff_at"] = time.time()
+            job_events.publish(job["job_id"], "progress", stage=name)  # For GET /result/{id}/events
+        return result
+
+
+@celery.task(name="services.pipeline.decode_stage")
+def decode_stage(job):
+    def stage(job):
+        store = get_blob_store()
+        for item in _items(job):
+            item["decoded_key"] = f"decoded_{_item_id(item)}.npy"
+            with store.open_read(item["input_key"]) as src:
+                image = decode_image(src, scale_for(job.get("tier")))
+            with store.open_write(item["decoded_key"]) as dst:
+                save_raw(image, dst)
+            store.delete(item["input_key"])
+            item["input_key"] = None
+        return job
+    return _run(job, "decode", stage)
+
+
+@celery.task(name="services.pipeline.infer_stage")
+def infer_stage(job):
+    def stage(job):
+        store = get_blob_store()
+        # An album's images run back to back on this worker, with the model already resident
+        for item in _items(job):
+            item["upscaled_key"] = f"upscaled_{_item_id(item)}.npy"
+            with _readable(store, item["decoded_key"]) as src:
+                image = load_raw(src)
+            start = time.perf_counter()
+            sr_image = run_model(image, tier=job.get("tier"))
+            _record_service_time(job, image.size, time.perf_counter() - start)
+            with store.open_write(item["upscaled_key"]) as dst:
+                save_raw(sr_image, dst)
+            store.delete(item["decoded_key"])
+            item["decoded_key"] = None
+        _release_slot(job)
+        return job
+    return _run(job, "infer", stage)
+
+
+@celery.task(name="services.pipeline.encode_stage")
+def encode_stage(job):
+    def stage(job):
+        store = get_blob_store()
+        for item in _items(job):
+            with _readable(store, item["upscaled_key"]) as src:
+                sr_image = load_raw(src)
+            with store.open_write(item["output_key"]) as dst:
+                encode_image(finalize_image(sr_image), dst)
+            store.delete(item["upscaled_key"])
+            item["upscaled_key"] = None
+        return job
+    return _run(job, "encode", stage)
+
+
+@celery.task(name="services.pipeline.deliver_stage")
+def deliver_stage(job):
+    """Charge the user, send the photo and return the output key for GET /result."""
+    def stage(job):
+        store = get_blob_store()
+        telegram_id = int(job["chat_id"])
+
+        if job.get("album"):
+            return _deliver_album(job, store)
+
+        # Cache hit: Telegram already has this result, resend it by file_id
+        if job.get("cached_file_id"):
+            usage_type = decrement_generation(telegram_id)
+            if send_photo(job["chat_id"], job["cached_file_id"], usage_caption(usage_type)) is None:
+                result_cache.invalidate(job["content_hash"])
+                raise RuntimeError("cached file_id could not be resent")
+            JOBS.labels("cached").inc()
+            job_events.publish(job["job_id"], "done", output_key=None)
+            return None
+
+        usage_type = decrement_generation(telegram_id)
+        with store.open_read(job["output_key"]) as photo:
+            file_id = send_photo(job["chat_id"], photo, usage_caption(usage_type))
+        if file_id is None:
+            raise RuntimeError("sendPhoto failed")
+
+        # Remember the delivered photo so repeats skip the model
+        if job.get("content_hash"):
+            result_cache.store(job["content_hash"], file_id)
+            deliver_to_waiters(job["content_hash"], file_id)
+        _release_user(job)
+        JOBS.labels("delivered").inc()
+
+        # Kept for GET /result until fetched or cleaned up after BLOB_TTL
+        job_events.publish(job["job_id"], "done", output_key=job["output_key"])
+        return job["output_key"]
+    return _run(job, "deliver", stage)
+
+
+def _deliver_album(job, store):
+    """Charge the whole album in one statement and send it back as one media group."""
+    items = job["album"]
+    charged = charge_generations(int(job["chat_id"]), len(items))
+    with ExitStack() as stack:
+        photos = [stack.enter_context(store.open_read(item["output_key"])) for item in items]
+        file_ids = send_media_group(job["chat_id"], photos, album_caption(charged, len(items)))
+    if not file_ids:
+        raise RuntimeError("sendMediaGroup failed")
+
+    _release_user(job)
+    JOBS.labels("delivered").inc(len(items))
+    # Albums only come from the bot, so nothing is kept for GET /result
+    for item in items:
+        store.delete(item["output_key"])
+    job_events.publish(job["job_id"], "done", output_key=None, images=len(items))
+    return None
+
+
+def new_job(job_id, chat_id, input_key=None, content_hash=None, cached_file_id=None, tier=None,
+            trace_id=None):
+    return {
+        "job_id": job_id,
+        "trace_id": trace_id or job_id,  # Caller's id for logs and spans; job_id keys tasks and blobs
+        "chat_id": str(chat_id),
+        "input_key": input_key,
+        "output_key": f"output_{job_id}.jpg" if input_key else None,
+        "decoded_key": None,
+        "upscaled_key": None,
+        "content_hash": content_hash,
+        "cached_file_id": cached_file_id,
+        "tier": tier,  # Model tier from core/models.py; None means the default
+        "handoff_at": time.time(),  # When the job was last queued, for queue-wait metrics
+    }
+
+
+def new_album_job(job_id, chat_id, input_keys, tier=None, trace_id=None):
+    """One job for a media group; each image gets its own blob keys."""
+    job = new_job(job_id, chat_id, tier=tier, trace_id=trace_id)
+    job["album"] = [
+        {
+            "item_id": f"{job_id}_{i}",
+            "input_key": key,
+            "decoded_key": None,
+            "upscaled_key": None,
+            "output_key": f"output_{job_id}_{i}.jpg",
+        }
+        for i, key in enumerate(input_keys)
+    ]
+    job["cost"] = len(input_keys)  # Scheduler fairness charge, in images
+    return job
+
+
+def submit_job(job, inference_queue):
+    """Queue a job; the returned AsyncResult (id == job_id) resolves to the output key."""
+    job["queue"] = inference_queue
+    if job.get("cached_file_id"):
+        return deliver_stage.s(job).set(queue=IO_QUEUE).apply_async(task_id=job["job_id"])
+
+    workflow = chain(
+        decode_stage.s(job).set(queue=IO_QUEUE),
+        infer_stage.s().set(queue=inference_queue),
+        encode_stage.s().set(queue=IO_QUEUE),
+        deliver_stage.s().set(queue=IO_QUEUE),
+    )
+    return workflow.apply_async(task_id=job["job_id"])
@@ -0,0 +1,33 @@
+# services/redis_client.py
+import os
+from dotenv import load_dotenv
+import redis
+import redis.asyncio
+
+load_dotenv()
+
+# Application data (caches, counters) lives next to the broker unless pointed elsewhere
+REDIS_URL = os.getenv("REDIS_URL") or os.getenv("REDIS_BROKER_URL") or "redis://localhost:6379/0"
+
+_client = None
+_async_client = None
+
+def get_redis():
+    """Process-wide Redis client (redis-py pools connections internally)."""
+    global _client
+    if _client is None:
+        _client = redis.Redis.from_url(REDIS_URL)
+    return _client
+
+def get_async_redis():
+    """Event-loop Redis client for the API (pub/sub waits for job results)."""
+    global _async_client
+    if _async_client is None:
+        _async_client = redis.asyncio.Redis.from_url(REDIS_URL)
+    return _async_client
+
+async def close_async_redis():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
@@ -0,0 +1,95 @@
+# services/result_cache.py
+import os
+import time
+
+from services.redis_client import get_redis
+
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "50000"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(30 * 24 * 3600)))  # Telegram file_ids stay valid for a long time
+INFLIGHT_TTL = int(os.getenv("INFLIGHT_TTL", "1800"))  # Safety net if a worker dies mid-job
+
+LRU_KEY = "result_cache:lru"
+
+# Become the leader for a content hash, or queue up as a waiter behind the current one.
+# Atomic with FINISH_SCRIPT so a waiter can never be added after the leader has drained the list.
+JOIN_SCRIPT = """
+local leader = redis.call('GET', KEYS[1])
+if leader then
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return leader
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[3])
+return false
+"""
+
+FINISH_SCRIPT = """
+local waiters = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[1], KEYS[2])
+return waiters
+"""
+
+
+def tier_key(digest, tier, default_tier="full"):
+    """Cache key for a result from a given model tier; the default tier keeps the bare hash."""
+    return digest if not tier or tier == default_tier else f"{digest}:{tier}"
+
+
+def _result_key(digest):
+    return f"result_cache:{digest}"
+
+
+def _inflight_keys(digest):
+    return f"inflight:{digest}", f"inflight:{digest}:waiters"
+
+
+def lookup(digest):
+    """Telegram file_id of the delivered result for this input, refreshing its LRU position."""
+    r = get_redis()
+    file_id = r.get(_result_key(digest))
+    if file_id is None:
+        return None
+    r.zadd(LRU_KEY, {digest: time.time()})
+    return file_id.decode()
+
+
+def store(digest, file_id):
+    """Remember the delivered photo's file_id and evict least recently used entries over the cap."""
+    r = get_redis()
+    pipe = r.pipeline()
+    pipe.set(_result_key(digest), file_id, ex=RESULT_CACHE_TTL)
+    pipe.zadd(LRU_KEY, {digest: time.time()})
+    pipe.execute()
+
+    overflow = r.zcard(LRU_KEY) - RESULT_CACHE_MAX_ENTRIES
+    if overflow > 0:
+        evicted = [d.decode() for d, _ in r.zpopmin(LRU_KEY, overflow)]
+        r.delete(*[_result_key(d) for d in evicted])
+
+
+def invalidate(digest):
+    r = get_redis()
+    r.delete(_result_key(digest))
+    r.zrem(LRU_KEY, digest)
+
+
+def inflight_leader(digest):
+    """Task id of the job currently computing this input, if any (read-only; doesn't join)."""
+    leader = get_redis().get(_inflight_keys(digest)[0])
+    return leader.decode() if leader else None
+
+
+def join_inflight(digest, task_id, chat_id):
+    """
+    Returns None if the caller is now the leader and must run the job,
+    otherwise the task id of the job already computing this input.
+    """
+    r = get_redis()
+    leader = r.eval(JOIN_SCRIPT, 2, *_inflight_keys(digest), task_id, chat_id, INFLIGHT_TTL)
+    return leader.decode() if leader else None
+
+
+def finish_inflight(digest):
+    """Release the in-flight slot and return the chat ids that coalesced onto it."""
+    waiters = get_redis().eval(FINISH_SCRIPT, 2, *_inflight_keys(digest))
+    return [w.decode() for w in waiters]
@@ -0,0 +1,291 @@
+# services/scheduler.py
+# Weighted fair scheduling between the vip and free tiers, with aging and per-user caps.
+#
+# The API enqueues jobs here instead of straight onto Celery. A single dispatcher process
+#   python -m services.scheduler
+# moves them to the Celery inference queues only while there is spare capacity, picking
+# the tier with the lowest (aged) virtual time and skipping users already at their cap.
+#
+# In-flight jobs are leases, not counters: sorted sets of job_id -> expiry time. Workers
+# renew them as the job moves through its stages and remove them when it is done. If a
+# worker dies mid-job, the lease simply runs out and the dispatcher reaps it.
+#
+# A user's waiting jobs are a sorted set changed in the same atomic step as the pending
+# list, so the per-user cap can't drift. A job the dispatcher has taken off the list but
+# not yet handed to Celery is parked in sched:dispatching; a new dispatcher puts any it
+# finds there back in the queue.
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from core.metrics import job_context, observe_queue_wait, start_exporter
+from services.redis_client import get_redis
+
+TIERS = ("vip", "free")
+TIER_WEIGHTS = {
+    "vip": float(os.getenv("SCHED_VIP_WEIGHT", "4")),
+    "free": float(os.getenv("SCHED_FREE_WEIGHT", "1")),
+}
+AGING_RATE = float(os.getenv("SCHED_AGING_RATE", "0.02"))  # Virtual-time credit per second waited
+BURST_CREDIT = float(os.getenv("SCHED_BURST_CREDIT", "4"))  # Max virtual time an idle tier can bank
+DISPATCH_CAPACITY = int(os.getenv("SCHED_DISPATCH_CAPACITY", "8"))  # Jobs allowed in inference at once
+MAX_INFLIGHT_PER_USER = int(os.getenv("SCHED_MAX_INFLIGHT_PER_USER", "2"))
+MAX_PENDING_PER_USER = int(os.getenv("SCHED_MAX_PENDING_PER_USER", "20"))
+SCAN_DEPTH = 50  # How far past a capped user's jobs the dispatcher looks within a tier
+SLOT_LEASE = int(os.getenv("SCHED_SLOT_LEASE", "900"))  # Seconds an inference slot is held without renewal
+USER_LEASE = int(os.getenv("SCHED_USER_LEASE", "1800"))  # Same for a user's in-flight slot, until delivery
+LEASE_RENEW_INTERVAL = min(SLOT_LEASE, USER_LEASE) / 3  # How often a running stage renews its leases
+LEADER_LEASE = 10  # Seconds the dispatcher lease lasts without renewal
+
+PENDING_KEY = "sched:pending:{}"
+VTIME_KEY = "sched:vtime"
+INFLIGHT_KEY = "sched:leases"  # job_id -> expiry, jobs holding an inference slot
+INFLIGHT_USER_KEY = "sched:leases:user:{}"  # job_id -> expiry, a user's jobs not yet delivered
+PENDING_USER_KEY = "sched:queued:user:{}"  # job_id -> enqueued_at, a user's jobs waiting for dispatch
+PENDING_USER_TTL = 24 * 3600  # Safety net so an abandoned user's set can't outlive its jobs
+DISPATCHING_KEY = "sched:dispatching"  # job_id -> {"tier", "raw"} between leaving the queue and Celery
+WAKEUP_KEY = "sched:wakeup"
+LEADER_KEY = "sched:dispatcher"
+
+
+# Check the user's cap and queue the job in one step
+ENQUEUE_SCRIPT = """
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+redis.call('RPUSH', KEYS[2], ARGV[5])
+redis.call('RPUSH', KEYS[3], 1)
+return 1
+"""
+
+# Take a job off its queue, take its leases and park it until it is submitted, in one step
+CLAIM_SCRIPT = """
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('ZREM', KEYS[2], ARGV[2])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[2])
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[2])
+redis.call('EXPIRE', KEYS[4], ARGV[5])
+redis.call('HSET', KEYS[5], ARGV[2], ARGV[6])
+return 1
+"""
+
+
+class QueueFull(Exception):
+    """The user already has MAX_PENDING_PER_USER jobs waiting."""
+
+
+class FairPolicy:
+    """
+    Start-time fair queueing over tiers. Each dispatch advances the tier's
+    virtual time by cost / weight, so over time tiers get slots in proportion
+    to their weights. A waiting head job earns AGING_RATE credit per second,
+    which guarantees free jobs are eventually picked even under VIP load.
+    Pure logic, shared by the dispatcher and benchmarks/scheduler_sim.py.
+    """
+
+    def __init__(self, weights=None, aging_rate=AGING_RATE, burst_credit=BURST_CREDIT):
+        self.weights = weights or TIER_WEIGHTS
+        self.aging_rate = aging_rate
+        self.burst_credit = burst_credit
+
+    def choose(self, head_waits, vtimes):
+        """Tier to serve next, given {tier: seconds its head job has waited} for non-empty tiers."""
+        if not head_waits:
+            return None
+        return min(head_waits, key=lambda tier: (vtimes.get(tier, 0.0) - self.aging_rate * head_waits[tier],
+                                                 -self.weights[tier]))
+
+    def charge(self, tier, vtimes, cost=1.0):
+        """Advance `tier` after a dispatch; returns the updated vtimes."""
+        vtimes[tier] = vtimes.get(tier, 0.0) + cost / self.weights[tier]
+        # Tiers that sat idle may only lag by BURST_CREDIT, so they can't monopolise on return
+        floor = vtimes[tier] - self.burst_credit
+        for other in self.weights:
+            vtimes[other] = max(vtimes.get(other, 0.0), floor)
+        return vtimes
+
+
+def enqueue(job, tier):
+    """Queue a job for dispatch. Raises QueueFull if the user has too many jobs waiting."""
+    now = time.time()
+    # The job's own "tier" is its model tier, so don't store the queue under that name
+    entry = dict(job, enqueued_at=now)
+    keys = (PENDING_USER_KEY.format(job["chat_id"]), PENDING_KEY.format(tier), WAKEUP_KEY)
+    if not get_redis().eval(ENQUEUE_SCRIPT, len(keys), *keys,
+                            job["job_id"], now, MAX_PENDING_PER_USER, PENDING_USER_TTL, json.dumps(entry)):
+        raise QueueFull(job["chat_id"])
+
+
+def pending_count(tier):
+    return get_redis().llen(PENDING_KEY.format(tier))
+
+
+def renew(job_id, chat_id, slot=False):
+    """Called as a job starts each stage; pushes back the expiry of the leases it still holds."""
+    now = time.time()
+    user_key = INFLIGHT_USER_KEY.format(chat_id)
+    pipe = get_redis().pipeline()
+    if slot:
+        pipe.zadd(INFLIGHT_KEY, {job_id: now + SLOT_LEASE}, xx=True)
+    pipe.zadd(user_key, {job_id: now + USER_LEASE}, xx=True)
+    pipe.expire(user_key, USER_LEASE)
+    pipe.execute()
+
+
+def release_slot(job_id):
+    """Called when a job leaves inference (done or failed); frees dispatch capacity."""
+    r = get_redis()
+    r.zrem(INFLIGHT_KEY, job_id)
+    r.rpush(WAKEUP_KEY, 1)
+
+
+def release_user(chat_id, job_id):
+    """Called when a job is finished or failed; frees one of the user's in-flight slots."""
+    r = get_redis()
+    r.zrem(INFLIGHT_USER_KEY.format(chat_id), job_id)
+    r.rpush(WAKEUP_KEY, 1)
+
+
+def _reap(r, key, now):
+    """Drop leases that ran out (their worker died or stalled); returns how many."""
+    return r.zremrangebyscore(key, "-inf", now)
+
+
+def _head_waits(r, now):
+    waits = {}
+    for tier in TIERS:
+        head = r.lindex(PENDING_KEY.format(tier), 0)
+        if head:
+            waits[tier] = now - json.loads(head)["enqueued_at"]
+    return waits
+
+
+def _claim(r, tier, raw, entry):
+    """Atomically move a queued job to in-flight: leases taken, parked in DISPATCHING_KEY."""
+    now = time.time()
+    keys = (PENDING_KEY.format(tier), PENDING_USER_KEY.format(entry["chat_id"]), INFLIGHT_KEY,
+            INFLIGHT_USER_KEY.format(entry["chat_id"]), DISPATCHING_KEY)
+    parked = json.dumps({"tier": tier, "raw": raw.decode() if isinstance(raw, bytes) else raw})
+    return r.eval(CLAIM_SCRIPT, len(keys), *keys,
+                  raw, entry["job_id"], now + SLOT_LEASE, now + USER_LEASE, USER_LEASE, parked)
+
+
+def _requeue(r, tier, raw, entry):
+    """Undo _claim: back to the head of its tier, leases released."""
+    pipe = r.pipeline()  # MULTI/EXEC
+    pipe.lpush(PENDING_KEY.format(tier), raw)
+    pipe.zadd(PENDING_USER_KEY.format(entry["chat_id"]), {entry["job_id"]: entry["enqueued_at"]})
+    pipe.expire(PENDING_USER_KEY.format(entry["chat_id"]), PENDING_USER_TTL)
+    pipe.zrem(INFLIGHT_KEY, entry["job_id"])
+    pipe.zrem(INFLIGHT_USER_KEY.format(entry["chat_id"]), entry["job_id"])
+    pipe.hdel(DISPATCHING_KEY, entry["job_id"])
+    pipe.execute()
+
+
+def recover_dispatching(r):
+    """Requeue jobs a previous dispatcher claimed but may not have submitted before it died."""
+    for job_id, value in r.hgetall(DISPATCHING_KEY).items():
+        parked = json.loads(value)
+        _requeue(r, parked["tier"], parked["raw"], json.loads(parked["raw"]))
+        print(f"[WARN] Requeued job {job_id.decode()} left mid-dispatch by a previous dispatcher")
+
+
+def _pop_eligible(r, tier, now):
+    """First job in the tier whose user is under the in-flight cap, claimed off the queue."""
+    key = PENDING_KEY.format(tier)
+    for raw in r.lrange(key, 0, SCAN_DEPTH - 1):
+        entry = json.loads(raw)
+        user_key = INFLIGHT_USER_KEY.format(entry["chat_id"])
+        if _reap(r, user_key, now):
+            print(f"[WARN] Reaped expired in-flight lease(s) of user {entry['chat_id']}")
+        if r.zcard(user_key) < MAX_INFLIGHT_PER_USER and _claim(r, tier, raw, entry):
+            return raw, entry
+    return None
+
+
+def dispatch_once(policy, submit):
+    """Dispatch at most one job; returns it, or None if nothing could be dispatched."""
+    r = get_redis()
+    now = time.time()
+    reaped = _reap(r, INFLIGHT_KEY, now)
+    if reaped:
+        print(f"[WARN] Reaped {reaped} expired inference slot(s); their workers likely died mid-job")
+    if r.zcard(INFLIGHT_KEY) >= DISPATCH_CAPACITY:
+        return None
+
+    waits = _head_waits(r, now)
+    vtimes = {k.decode(): float(v) for k, v in r.hgetall(VTIME_KEY).items()}
+    while waits:
+        tier = policy.choose(waits, vtimes)
+        claimed = _pop_eligible(r, tier, now)
+        if claimed is None:
+            # Every scanned job in this tier belongs to a capped user; try the other tier
+            waits.pop(tier)
+            continue
+
+        # The claim took the slots before submitting, so a fast job can't release them first
+        raw, entry = claimed
+        job = {k: v for k, v in entry.items() if k != "enqueued_at"}
+        job["scheduled"] = True
+        job["handoff_at"] = time.time()
+        try:
+            submit(job, tier)
+        except Exception:
+            # Broker unavailable: give the slots back and put the job at the head of its tier
+            _requeue(r, tier, raw, entry)
+            raise
+
+        policy.charge(tier, vtimes, entry.get("cost", 1.0))
+        pipe = r.pipeline()
+        pipe.hset(VTIME_KEY, mapping=vtimes)
+        pipe.hdel(DISPATCHING_KEY, entry["job_id"])
+        pipe.execute()
+        with job_context(job["job_id"]):
+            observe_queue_wait(f"dispatch_{tier}", entry["enqueued_at"])
+        print(f"[📤 DISPATCH] {job['job_id']} ({tier}) after {time.time() - entry['enqueued_at']:.1f}s")
+        return job
+    return None
+
+
+def _hold_leadership(r, token):
+    """Extend the dispatcher lease if we still hold it."""
+    if r.get(LEADER_KEY) != token.encode():
+        return False
+    r.expire(LEADER_KEY, LEADER_LEASE)
+    return True
+
+
+def run_dispatcher(poll_interval=0.5):
+    """Main loop. A Redis lease makes sure only one dispatcher is active at a time."""
+    from services.pipeline import submit_job
+
+    start_exporter()
+    r = get_redis()
+    policy = FairPolicy()
+    token = f"{os.uname().nodename}:{os.getpid()}"
+    print("[⏳ SCHEDULER] Waiting for dispatcher lease")
+    while True:
+        if r.set(LEADER_KEY, token, nx=True, ex=LEADER_LEASE):
+            # Newly the leader: whatever the last one left mid-dispatch goes back in the queue
+            recover_dispatching(r)
+        if _hold_leadership(r, token):
+            try:
+                # Renewed before every dispatch, so a long backlog can't outlast the lease
+                while dispatch_once(policy, submit_job) and _hold_leadership(r, token):
+                    pass
+            except Exception as e:
+                print(f"[❌ SCHEDULER] Dispatch failed: {e}")
+                time.sleep(1)
+        # Sleep until something is enqueued or released; collapse any backlog of wake-ups
+        if r.blpop(WAKEUP_KEY, timeout=poll_interval):
+            r.delete(WAKEUP_KEY)
+
+
+if __name__ == "__main__":
+    run_dispatcher()
@@ -4,57 +4,165 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from services.celery_app import celery
+import json
 import requests
 from core.db import decrement_generation
 from core.upscale_fn import upscale_image
+from core.storage import get_blob_store
+from services import result_cache
+from core.metrics import span, job_context
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 
+def usage_caption(usage_type):
+    caption = "✅ Here is your upscaled image!\n"
+
+    if usage_type == "vip":
+        caption += "💎 1 *VIP Token* used!"
+    elif usage_type == "free":
+        caption += "🎁 1 Free Token used!"
+    return caption
+
+
+def album_caption(charged, count):
+    caption = f"✅ Here are your {count} upscaled images!\n"
+    if charged and charged["vip"]:
+        caption += f"💎 {charged['vip']} *VIP Token{'s' if charged['vip'] != 1 else ''}* used!\n"
+    if charged and charged["free"]:
+        caption += f"🎁 {charged['free']} Free Token{'s' if charged['free'] != 1 else ''} used!"
+    return caption.rstrip("\n")
+
+
+def send_photo(chat_id, photo, caption):
+    """
+    Send a photo via the Telegram API. `photo` is either an open file to upload
+    or the file_id of a photo Telegram already has. Returns the file_id of the
+    largest size Telegram stored, or None if sending failed.
+    """
+    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
+    data = {
+        'chat_id': chat_id,
+        'caption': caption,
+        'parse_mode': 'Markdown'  # You can change to 'HTML' if needed
+    }
+    with span("telegram_upload"):
+        if isinstance(photo, str):
+            data['photo'] = photo
+            response = requests.post(url, data=data)
+        else:
+            response = requests.post(url, data=data, files={'photo': photo})
+    print(f"[Telegram] {response.status_code} | {response.text}")
+
+    if response.status_code != 200:
+        return None
+    sizes = response.json().get("result", {}).get("photo") or []
+    return sizes[-1]["file_id"] if sizes else None
+
+
+def send_media_group(chat_id, photos, caption):
+    """
+    Send 2-10 open photo files as one album via the Telegram API, with the caption
+    on the first. Returns the file_ids Telegram stored, or None if sending failed.
+    """
+    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMediaGroup"
+    media = [{"type": "photo", "media": f"attach://photo{i}"} for i in range(len(photos))]
+    media[0].update(caption=caption, parse_mode="Markdown")
+    files = {f"photo{i}": photo for i, photo in enumerate(photos)}
+    with span("telegram_upload"):
+        response = requests.post(url, data={"chat_id": chat_id, "media": json.dumps(media)}, files=files)
+    print(f"[Telegram] {response.status_code} | {response.text}")
+
+    if response.status_code != 200:
+        return None
+    messages = response.json().get("result") or []
+    return [m["photo"][-1]["file_id"] for m in messages if m.get("photo")]
+
+
+def notify_failure(chat_id):
+    try:
+        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+        data = {'chat_id': chat_id, 'text': '❌ Failed to send the upscaled image.'}
+        requests.post(url, data=data)
+    except Exception as notify_err:
+        print(f"[❌ Notify Fail] {notify_err}")
+
+
+def deliver_to_waiters(content_hash, file_id):
+    """Send the finished result to every chat that coalesced onto this job."""
+    for waiter in result_cache.finish_inflight(content_hash):
+        try:
+            if file_id is None:
+                raise RuntimeError("no result to resend")
+            usage_type = decrement_generation(int(waiter))
+            if send_photo(waiter, file_id, usage_caption(usage_type)) is None:
+                raise RuntimeError("sendPhoto by file_id failed")
+        except Exception as e:
+            print(f"[❌ ERROR] Coalesced delivery to {waiter}: {e}")
+            notify_failure(waiter)
+
+
+# Single-task path: the whole job on one worker. New jobs go through services/pipeline.py;
+# this stays registered so messages queued by older API versions still run.
 @celery.task(name="services.tasks.upscale_image_task")
-def upscale_image_task(input_path: str, output_path: str, chat_id: str):
+def upscale_image_task(input_key: str, output_key: str, chat_id: str,
+                       content_hash: str = None, cached_file_id: str = None,
+                       job_id: str = None, tier: str = None):
+    with job_context(job_id):
+        return _upscale_image_job(input_key, output_key, chat_id, content_hash, cached_file_id, tier)
+
+
+def _upscale_image_job(input_key, output_key, chat_id, content_hash, cached_file_id, tier):
     telegram_id = int(chat_id)
+    store = get_blob_store()
+    file_id = None
 
     try:
-        # 1. Run the upscaling
-        upscale_image(input_path, output_path)
+        # Cache hit: Telegram already has this result, resend it by file_id
+        if cached_file_id:
+            usage_type = decrement_generation(telegram_id)
+            if send_photo(chat_id, cached_file_id, usage_caption(usage_type)) is None:
+                result_cache.invalidate(content_hash)
+                raise RuntimeError("cached file_id could not be resent")
+            return None
+
+        # 1. Run the upscaling, streaming from and to the blob store
+        with store.open_read(input_key) as src, store.open_write(output_key) as dst:
+            upscale_image(src, dst, tier=tier)
 
         # 2. Decrement user's generation count
         usage_type = decrement_generation(telegram_id)
 
         # 3. Send image via Telegram API
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendPhoto"
-        with open(output_path, "rb") as photo:
-            caption = "✅ Here is your upscaled image!\n"
-
-            if usage_type == "vip":
-                caption += "💎 1 *VIP Token* used!"
-            elif usage_type == "free":
-                caption += "🎁 1 Free Token used!"
-
-            data = {
-                'chat_id': chat_id,
-                'caption': caption,
-                'parse_mode': 'Markdown'  # You can change to 'HTML' if needed
-            }
-            files = {'photo': photo}
-            response = requests.post(url, data=data, files=files)
-            print(f"[Telegram] {response.status_code} | {response.text}")
+        with store.open_read(output_key) as photo:
+            file_id = send_photo(chat_id, photo, usage_caption(usage_type))
+
+        # 4. Remember the delivered photo so repeats skip the model
+        if content_hash and file_id:
+            result_cache.store(content_hash, file_id)
+
+        # Kept for GET /result until fetched or cleaned up after BLOB_TTL
+        return output_key
 
     except Exception as e:
         print(f"[❌ ERROR] {e}")
-        try:
-            url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-            data = {'chat_id': chat_id, 'text': '❌ Failed to send the upscaled image.'}
-            requests.post(url, data=data)
-        except Exception as notify_err:
-            print(f"[❌ Notify Fail] {notify_err}")
+        notify_failure(chat_id)
+        if output_key:
+            store.delete(output_key)
 
     finally:
+        if content_hash and not cached_file_id:
+            deliver_to_waiters(content_hash, file_id)
         try:
-            if os.path.exists(input_path):
-                os.remove(input_path)
-            if os.path.exists(output_path):
-                os.remove(output_path)
+            if input_key:
+                store.delete(input_key)
         except Exception as cleanup_err:
             print(f"[WARN] Cleanup failed: {cleanup_err}")
+
+
+@celery.task(name="services.tasks.cleanup_blobs_task")
+def cleanup_blobs_task():
+    """Drop blobs older than BLOB_TTL that no request claimed."""
+    removed = get_blob_store().cleanup()
+    print(f"[🧹 CLEANUP] Removed {removed} stale blob(s)")
+    return removed
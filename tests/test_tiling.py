@@ -0,0 +1,100 @@
+# tests/test_tiling.py
+# TilePlan (core/tiling.py) and BandAssembler (core/assembly.py) without a model:
+# tiles are blended back unchanged, so the assembled image must equal the input.
+#
+#   python -m pytest tests
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+pytest.importorskip("PIL")
+
+from core.assembly import BandAssembler
+from core.tiling import TilePlan
+
+
+def weight_sum(plan):
+    """Sum of every tile's blending weights over the padded output."""
+    total = torch.zeros((1, *plan.output_size))
+    th, tw = plan.tile_h * plan.scale, plan.tile_w * plan.scale
+    for y, x in plan.tiles:
+        oy, ox = y * plan.scale, x * plan.scale
+        total[:, oy:oy + th, ox:ox + tw] += plan.weight(y, x)
+    return total
+
+
+def assemble(image, plan, rows_per_band=1):
+    """Run `image` (1, 3, H, W) through the plan and assembler like upscale_image, with scale 1."""
+    padded = plan.pad(image)
+    th, tw = plan.tile_h, plan.tile_w
+    bands = [plan.ys[i:i + rows_per_band] for i in range(0, len(plan.ys), rows_per_band)]
+    band_h = max(band[-1] - band[0] + th for band in bands)
+    assembler = BandAssembler(band_h, plan.output_size[1], plan.height, plan.width, "cpu")
+    for band in bands:
+        assembler.advance(band[0])
+        for y in band:
+            for x in plan.xs:
+                assembler.add(padded[0, :, y:y + th, x:x + tw], plan.weight(y, x), y, x)
+    return np.asarray(assembler.finish())
+
+
+def random_image(height, width, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    levels = torch.randint(0, 256, (1, 3, height, width), generator=generator)
+    return levels.float() / 255, levels[0].permute(1, 2, 0).numpy().astype(np.uint8)
+
+
+@pytest.mark.parametrize("height,width", [(100, 130), (64, 64), (33, 200), (512, 40)])
+def test_tiles_cover_the_whole_output(height, width):
+    plan = TilePlan(height, width, tile_size=32, overlap=4, scale=2)
+    covered = torch.zeros(plan.output_size, dtype=torch.bool)
+    for y, x in plan.tiles:
+        covered[y * 2:(y + plan.tile_h) * 2, x * 2:(x + plan.tile_w) * 2] = True
+    assert covered.all()
+    assert (weight_sum(plan) > 0).all()
+
+
+def test_weights_sum_to_one_where_tiles_overlap_by_the_ramp():
+    # 56 = 32 + 24: two tiles per axis that overlap by exactly `overlap`
+    plan = TilePlan(56, 56, tile_size=32, overlap=8, scale=2)
+    assert plan.ys == [0, 24] and plan.xs == [0, 24]
+    assert torch.allclose(weight_sum(plan), torch.ones(1, 112, 112))
+
+
+@pytest.mark.parametrize("length", [64, 96, 100, 512])
+def test_last_tile_is_shifted_inward(length):
+    plan = TilePlan(length, length, tile_size=32, overlap=8, scale=4)
+    for starts, tile in ((plan.ys, plan.tile_h), (plan.xs, plan.tile_w)):
+        assert starts[0] == 0
+        assert starts[-1] + tile == length
+        assert starts == sorted(set(starts))
+        # Neighbours overlap by at least `overlap`, so the ramps have room to blend
+        assert all(b - a <= tile - 8 for a, b in zip(starts, starts[1:]))
+
+
+@pytest.mark.parametrize("height,width", [(10, 12), (5, 7), (1, 1), (20, 3)])
+def test_tiny_images_are_padded_to_one_tile(height, width):
+    plan = TilePlan(height, width, tile_size=512, overlap=8, scale=4)
+    assert len(plan) == 1
+    assert plan.tile_h % 16 == 0 and plan.tile_w % 16 == 0
+    assert plan.output_size == (plan.tile_h * 4, plan.tile_w * 4)
+
+    image, _ = random_image(height, width)
+    padded = plan.pad(image)
+    assert padded.shape == (1, 3, plan.tile_h, plan.tile_w)
+    assert torch.equal(padded[:, :, :height, :width], image)
+
+
+@pytest.mark.parametrize("height,width,rows_per_band", [
+    (100, 130, 1),
+    (100, 130, 2),
+    (64, 96, 1),   # Exact multiples
+    (10, 12, 1),   # Smaller than a tile
+])
+def test_assembly_round_trips_the_image(height, width, rows_per_band):
+    plan = TilePlan(height, width, tile_size=32, overlap=4, scale=1)
+    image, expected = random_image(height, width)
+    result = assemble(image, plan, rows_per_band)
+    assert result.shape == (height, width, 3)
+    # uint8 conversion truncates, so a blended value can land one level low
+    assert np.abs(result.astype(int) - expected.astype(int)).max() <= 1
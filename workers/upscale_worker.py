@@ -0,0 +1,51 @@
+# workers/upscale_worker.py
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from celery.signals import worker_init, worker_process_init, worker_process_shutdown
+
+from core.metrics import start_exporter, mark_process_dead
+
+# Set to 0 on workers that never run inference
+PRELOAD_MODEL = os.getenv("PRELOAD_MODEL", "1") == "1"
+
+
+@worker_init.connect
+def prepare_shared_weights(**kwargs):
+    """
+    Runs once in the parent before the pool forks. Converting the checkpoint
+    here means every child maps the same file instead of racing to write it.
+    """
+    # One exporter in the parent; children's samples reach it via PROMETHEUS_MULTIPROC_DIR
+    start_exporter()
+    if not PRELOAD_MODEL:
+        return
+    from core.models import MODEL_TIERS
+    from core.upscale_fn import PRELOAD_TIERS, INFERENCE_SERVER_ADDRESS, device
+    from core.weights import ensure_mmap_weights
+
+    if device.type == "cpu" and not INFERENCE_SERVER_ADDRESS:
+        for tier in PRELOAD_TIERS:
+            spec = MODEL_TIERS.get(tier)
+            if spec and spec.available():
+                ensure_mmap_weights(spec.weights_path)
+
+
+@worker_process_init.connect
+def preload_model(**kwargs):
+    """Load the model and warm it up in each child before it accepts tasks."""
+    if not PRELOAD_MODEL:
+        return
+    from core.upscale_fn import warm_up
+
+    try:
+        warm_up()
+    except Exception as e:
+        # The task path still calls load_model() lazily, so a failed preload is not fatal
+        print(f"[WARN] Model preload failed in pid {os.getpid()}: {e}")
+
+
+@worker_process_shutdown.connect
+def drop_process_metrics(pid=None, **kwargs):
+    mark_process_dead(pid or os.getpid())